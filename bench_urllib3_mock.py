@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the interception hot path of urllib3-mock.
+
+Run ``python bench_urllib3_mock.py`` to print the results as JSON, one
+object per measurement, with the time per operation in microseconds.
+Use ``--quick`` for a smaller matrix and ``--output FILE`` to save them.
+"""
+
+import argparse
+import json
+import platform
+import re
+import statistics
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import urllib3
+from urllib3_mock import Responses, uninstall
+
+Pool = namedtuple('Pool', ['scheme', 'host', 'port'])
+POOL = Pool('http', 'example.com', 80)
+
+
+def measure(func, number, repeat=5):
+    # Return the best and the median time per call, in microseconds
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return min(timings), statistics.median(timings)
+
+
+def register(responses, kind, count, body=b''):
+    # Register `count` routes of the given kind, return a matching URL
+    # for the last one (the worst case for a linear scan).
+    for i in range(count):
+        if kind == 'exact':
+            responses.add('GET', '/route/%d' % i, body=body)
+        elif kind == 'regex':
+            responses.add('GET', re.compile(r'/route/%d/\d+$' % i), body=body)
+        elif kind == 'querystring':
+            responses.add('GET', '/route?id=%d&page=1' % i, body=body,
+                          match_querystring=True)
+        elif kind == 'callback':
+            responses.add_callback(
+                'GET', '/route/%d' % i, lambda request: (200, None, body))
+    last = count - 1
+    return {
+        'exact': '/route/%d' % last,
+        'regex': '/route/%d/42' % last,
+        'querystring': '/route?page=1&id=%d' % last,
+        'callback': '/route/%d' % last,
+    }[kind]
+
+
+def bench_routes(route_counts, number):
+    for kind in ('exact', 'regex', 'querystring', 'callback'):
+        for count in route_counts:
+            if kind == 'regex' and count > 10000:
+                continue  # compiling the combined pattern dominates
+            responses = Responses()
+            url = register(responses, kind, count)
+            request = responses._request_class('GET', url, None, {},
+                                               *POOL)
+            responses._find_match(request)  # build the lazy matchers
+            for name, func in (
+                ('find_match', lambda: responses._find_match(request)),
+                ('urlopen', lambda: responses._urlopen(POOL, 'GET', url)),
+            ):
+                best, median = measure(func, number)
+                yield {'bench': name, 'kind': kind, 'routes': count,
+                       'best_us': best, 'median_us': median}
+
+
+def bench_body_sizes(body_sizes, number):
+    for size in body_sizes:
+        responses = Responses()
+        responses.add('GET', '/', body=b'x' * size)
+
+        def func():
+            responses._urlopen(POOL, 'GET', '/').read()
+        best, median = measure(func, number)
+        yield {'bench': 'urlopen_read', 'body_size': size,
+               'best_us': best, 'median_us': median}
+
+
+def bench_threads(thread_counts, number):
+    for threads in thread_counts:
+        for threadsafe in (False, True):
+            responses = Responses(threadsafe=threadsafe)
+            responses.add('GET', '/', body=b'test')
+
+            def worker():
+                for _ in range(number):
+                    responses._urlopen(POOL, 'GET', '/')
+
+            def func():
+                workers = [threading.Thread(target=worker)
+                           for _ in range(threads)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+                len(responses.calls)
+                responses.calls.clear()
+            best, median = measure(func, 1)
+            yield {'bench': 'threads', 'threads': threads,
+                   'threadsafe': threadsafe,
+                   'best_us': best / (threads * number),
+                   'median_us': median / (threads * number)}
+
+
+def bench_start_stop(number):
+    for persistent in (False, True):
+        responses = Responses(persistent=persistent)
+
+        def func():
+            responses.start()
+            responses.stop()
+        best, median = measure(func, number)
+        yield {'bench': 'start_stop', 'persistent': persistent,
+               'best_us': best, 'median_us': median}
+
+
+def bench_round_trip(number):
+    responses = Responses()
+    responses.add('GET', '/', body=b'test')
+    http = urllib3.PoolManager()
+    with responses:
+        best, median = measure(
+            lambda: http.request('GET', 'http://example.com/'), number)
+        yield {'bench': 'round_trip', 'client': 'urllib3',
+               'best_us': best, 'median_us': median}
+        try:
+            import requests
+        except ImportError:
+            return
+        session = requests.Session()
+        best, median = measure(
+            lambda: session.get('http://example.com/'), number)
+        yield {'bench': 'round_trip', 'client': 'requests',
+               'best_us': best, 'median_us': median}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--quick', action='store_true',
+                        help='run a smaller matrix')
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        number, route_counts = 200, (10, 1000)
+        body_sizes, thread_counts = (0, 1024), (1, 8)
+    else:
+        number, route_counts = 2000, (10, 100, 1000, 10000, 100000)
+        body_sizes, thread_counts = (0, 1024, 64 * 1024, 1024 * 1024), (
+            1, 8, 32)
+
+    results = {
+        'python': platform.python_version(),
+        'urllib3': urllib3.__version__,
+        'results': [],
+    }
+    for bench in (bench_routes(route_counts, number),
+                  bench_body_sizes(body_sizes, number // 10),
+                  bench_threads(thread_counts, number // 10),
+                  bench_start_stop(number // 10),
+                  bench_round_trip(number // 10)):
+        for result in bench:
+            results['results'].append(result)
+            sys.stderr.write(json.dumps(result) + '\n')
+
+    uninstall()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+pytest plugin for urllib3-mock.
+
+The ``urllib3_mock`` fixture yields an active ``Responses`` with a fresh
+call log for each test. The route manifests listed in the
+``urllib3_mock_routes`` ini option are compiled once per session (once
+per worker with pytest-xdist) and shared read-only by every test.
+"""
+
+import os
+
+import pytest
+
+from urllib3_mock import Responses, load_routes
+
+
+def pytest_addoption(parser):
+    parser.addini('urllib3_mock_package',
+                  'urllib3 package(s) mocked by the urllib3_mock fixture',
+                  type='args', default=['urllib3'])
+    parser.addini('urllib3_mock_routes',
+                  'route manifests shared by all the tests of the session',
+                  type='linelist', default=[])
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'urllib3_mock(**kwargs): arguments for the Responses '
+        'of the urllib3_mock fixture')
+
+
+def _base_dir(config):
+    inipath = getattr(config, 'inipath', None)
+    if inipath is not None:
+        return str(inipath.parent)
+    return str(config.rootdir)
+
+
+@pytest.fixture(scope='session')
+def urllib3_mock_routes(pytestconfig):
+    # Each xdist worker is a separate session, hence builds its own tables
+    base_dir = _base_dir(pytestconfig)
+    return tuple(
+        load_routes(os.path.join(base_dir, path)).freeze()
+        for path in pytestconfig.getini('urllib3_mock_routes'))
+
+
+@pytest.fixture
+def urllib3_mock(request, pytestconfig, urllib3_mock_routes):
+    kwargs = {'package': pytestconfig.getini('urllib3_mock_package'),
+              'persistent': True}
+    marker = request.node.get_closest_marker('urllib3_mock')
+    if marker is not None:
+        kwargs.update(marker.kwargs)
+    responses = Responses(**kwargs)
+    for table in urllib3_mock_routes:
+        responses.attach(table)
+    with responses:
+        yield responses
@@ -34,6 +34,7 @@ tests_require = [
     'pytest-cov',
     'flake8',
     'requests',
+    'PyYAML',
 ]
 
 
@@ -61,11 +62,15 @@ setup(
     ),
     license='Apache 2.0',
     long_description=long_description,
-    py_modules=['urllib3_mock'],
+    py_modules=['urllib3_mock', 'pytest_urllib3_mock'],
+    entry_points={
+        'pytest11': ['urllib3_mock = pytest_urllib3_mock'],
+    },
     zip_safe=False,
     install_requires=install_requires,
     extras_require={
         'tests': tests_require,
+        'yaml': ['PyYAML'],
     },
     tests_require=tests_require,
     setup_requires=setup_requires,
@@ -76,6 +81,7 @@ setup(
         'Intended Audience :: System Administrators',
         'Operating System :: OS Independent',
         'Topic :: Software Development',
+        'Framework :: Pytest',
         'Programming Language :: Python :: 3',
     ],
 )
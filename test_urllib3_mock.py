@@ -1,16 +1,51 @@
+import asyncio
+import copy
+import gzip
+import hashlib
 import inspect
+import json
+import multiprocessing
+import os
+import pickle
 import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.client import HTTPConnection, RemoteDisconnected
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from inspect import (
     getargspec,
     getfullargspec,
 )
+from io import BytesIO
 
 import pytest
 import requests
 from requests.exceptions import ConnectionError
-from requests.packages.urllib3.exceptions import ProtocolError, HTTPError
+from requests.packages.urllib3 import PoolManager
+from requests.packages.urllib3.exceptions import (
+    ConnectTimeoutError,
+    EmptyPoolError,
+    HTTPError,
+    MaxRetryError,
+    ProtocolError,
+)
+
+import urllib3_mock
+from urllib3_mock import (
+    BodyDigest,
+    CallList,
+    Latency,
+    RemoteResponse,
+    Request,
+    Responses,
+    RouteTable,
+    load_routes,
+)
 
-from urllib3_mock import Responses
+pytest_plugins = 'pytester'
 
 responses = Responses('requests.packages.urllib3')
 
@@ -449,3 +484,1343 @@ def test_allow_redirects_samehost():
 
     run()
     assert_reset()
+
+
+def test_first_registered_route_wins():
+    @responses.activate
+    def run():
+        responses.add(responses.GET, re.compile(r'/api/.*'), body='regex')
+        responses.add(responses.GET, '/api/exact', body='exact')
+        responses.add(responses.GET, '/other', body='exact')
+        responses.add(responses.ANY, '/other', body='any')
+        for i in range(1000):
+            responses.add(responses.GET, '/route/{0}'.format(i),
+                          body='route {0}'.format(i))
+        responses.add(responses.GET, '/route/1', body='duplicate')
+
+        assert requests.get('http://example.com/api/exact').text == 'regex'
+        assert requests.get('http://example.com/other').text == 'exact'
+        assert requests.post('http://example.com/other').text == 'any'
+        resp = requests.get('http://example.com/route/1?foo=bar')
+        assert resp.text == 'route 1'
+        resp = requests.get('http://example.com/route/999')
+        assert resp.text == 'route 999'
+
+        with pytest.raises(ConnectionError):
+            requests.post('http://example.com/route/1')
+
+    run()
+    assert_reset()
+
+
+def test_regular_expression_url_order():
+    @responses.activate
+    def run():
+        responses.add(responses.POST, re.compile(r'/a'), body='post')
+        responses.add(responses.GET, re.compile(r'/(a)(b)?\1'), body='backref')
+        responses.add(responses.GET, re.compile(r'/A', re.I), body='nocase')
+        responses.add(responses.ANY, re.compile(r'/(?P<x>a)'), body='any')
+        responses.add(responses.GET, re.compile(r'/a'), body='last')
+
+        assert requests.get('http://example.com/aa').text == 'backref'
+        assert requests.get('http://example.com/ab').text == 'nocase'
+        assert requests.post('http://example.com/ab').text == 'post'
+        assert requests.put('http://example.com/ab').text == 'any'
+
+        responses.add(responses.PUT, re.compile(r'/b'), body='put')
+        assert requests.put('http://example.com/b').text == 'put'
+        with pytest.raises(ConnectionError):
+            requests.put('http://example.com/c')
+
+    run()
+    assert_reset()
+
+
+def test_match_querystring_many_routes():
+    @responses.activate
+    def run():
+        for i in range(100):
+            responses.add(responses.GET, '/?page={0}&size=10'.format(i),
+                          match_querystring=True, body=str(i))
+        responses.add(responses.GET, '/', body='default')
+        responses.add(responses.GET, '/?size=10&page=1',
+                      match_querystring=True, body='duplicate')
+
+        resp = requests.get('http://example.com/?size=10&page=42')
+        assert resp.text == '42'
+        resp = requests.get('http://example.com/?page=1&size=10')
+        assert resp.text == '1'
+        resp = requests.get('http://example.com/?page=100&size=10')
+        assert resp.text == 'default'
+
+    run()
+    assert_reset()
+
+
+def test_static_route_template_is_reused():
+    @responses.activate
+    def run():
+        responses.add(responses.GET, '/', body='teapot',
+                      status="418 I'm a teapot",
+                      adding_headers={'Content-Type': 'text/html', 'x': 'y'})
+        resp1 = requests.get('http://example.com')
+        resp1.headers['x'] = 'changed'
+        resp2 = requests.get('http://example.com')
+        for resp in (resp1, resp2):
+            assert resp.status_code == 418
+            assert resp.reason == "I'm a teapot"
+            assert resp.text == 'teapot'
+            assert resp.headers['Content-Type'] == 'text/html'
+        assert resp2.headers['x'] == 'y'
+        assert len(resp2.raw._original_response.msg) == 2
+        assert responses.calls[0].response is not responses.calls[1].response
+
+    run()
+    assert_reset()
+
+
+def test_header_multimap():
+    @responses.activate
+    def run():
+        headers = [('Set-Cookie', 'a=1'), ('X-Trace', 'one'),
+                   ('set-cookie', 'b=2'), ('SET-COOKIE', 'c=3')]
+        headers += [('X-Header-%d' % i, str(i)) for i in range(200)]
+        responses.add(responses.GET, '/', body='test',
+                      adding_headers=headers)
+        resp1 = requests.get('http://example.com')
+        resp2 = requests.get('http://example.com')
+        assert dict(resp1.cookies) == {'a': '1', 'b': '2', 'c': '3'}
+
+        msg = resp1.raw._original_response.msg
+        # built once, shared by the responses of the route
+        assert msg is resp2.raw._original_response.msg
+        assert msg[:2] == (('Content-Type', 'text/plain'),
+                           ('Set-Cookie', 'a=1'))
+        assert len(msg) == 205
+        assert msg.get_all('set-cookie') == ['a=1', 'b=2', 'c=3']
+        assert msg.getheaders('X-HEADER-199') == ['199']
+        assert msg.get_all('Missing') == []
+        # the shared values cannot be changed through the result
+        msg.get_all('Set-Cookie').append('d=4')
+        assert msg.get_all('Set-Cookie') == ['a=1', 'b=2', 'c=3']
+
+    run()
+    assert_reset()
+
+
+def test_record_last_calls():
+    recent = Responses('requests.packages.urllib3', max_calls=2)
+    with recent:
+        recent.add(recent.GET, '/', body='test')
+        for i in range(5):
+            requests.get('http://example.com/?i={0}'.format(i))
+        assert len(recent.calls) == 2
+        assert recent.calls[0].request.url == '/?i=3'
+        assert recent.calls[-1].request.url == '/?i=4'
+    assert len(recent.calls) == 0
+
+
+def test_record_counters():
+    counting = Responses('requests.packages.urllib3', record='counters')
+    with counting:
+        counting.add(counting.GET, '/', body='test')
+        counting.add(counting.ANY, '/teapot', status="418 I'm a teapot")
+        for i in range(3):
+            requests.get('http://example.com/')
+        requests.post('http://example.com/teapot')
+        with pytest.raises(ConnectionError):
+            requests.get('http://example.com/missing')
+
+        calls = counting.calls
+        assert len(calls) == 5
+        assert calls.by_route == {('GET', '/'): 3, ('*', '/teapot'): 1,
+                                  None: 1}
+        assert calls.by_status == {200: 3, 418: 1, 'ProtocolError': 1}
+
+
+def test_threadsafe_recording_policy():
+    def fetch_all(responses):
+        responses.add(responses.GET, '/', body='test')
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(requests.get, ['http://example.com/'] * 200))
+        return responses._registry.log
+
+    counting = Responses('requests.packages.urllib3', threadsafe=True,
+                         record='counters')
+    with counting:
+        log = fetch_all(counting)
+        # only the counter keys are buffered
+        assert all(buf[0] == (('GET', '/'), 200) for (_, buf) in log._buffers)
+        assert counting.calls.by_route == {('GET', '/'): 200}
+        # the buffers of the finished threads are dropped
+        assert log._buffers == []
+
+    recent = Responses('requests.packages.urllib3', threadsafe=True,
+                       max_calls=10)
+    with recent:
+        log = fetch_all(recent)
+        assert all(len(buf) <= 10 for (_, buf) in log._buffers)
+        assert len(recent.calls) == 10
+
+    silent = Responses('requests.packages.urllib3', threadsafe=True,
+                       record='off')
+    with silent:
+        fetch_all(silent)
+        assert len(silent.calls) == 0
+
+
+def test_call_queries():
+    @responses.activate
+    def run():
+        responses.add(responses.GET, '/users', body='[]')
+        responses.add(responses.ANY, re.compile(r'/users/\d+$'), body='{}')
+        for i in range(3):
+            requests.get('http://example.com/users?page={0}'.format(i))
+            requests.post('http://other.com/users/{0}'.format(i))
+        with pytest.raises(ConnectionError):
+            requests.get('http://example.com/missing')
+
+        calls = responses.calls
+        assert len(calls.filter(method='GET')) == 4
+        assert len(calls.filter(host='other.com')) == 3
+        assert len(calls.filter(path='/users', host='example.com')) == 3
+        assert calls.filter(path='/users', host='other.com') == []
+        assert calls.filter(host='nowhere') == []
+        assert len(calls.filter()) == 7
+
+        assert calls.count_route(('GET', '/users')) == 3
+        users = (responses.ANY, re.compile(r'/users/\d+$'))
+        assert calls.count_route(users) == 3
+        assert calls.count_route(None) == 1
+        assert len(calls.filter(route=users, host='other.com')) == 3
+        # list semantics
+        assert calls.count(calls[0]) == 1
+        assert calls.count(('GET', '/users')) == 0
+
+        assert calls.last(method='POST').request.url == '/users/2'
+        assert calls.last(path='/users').request.url == '/users?page=2'
+        assert calls.last(host='nowhere') is None
+        with pytest.raises(TypeError):
+            calls.filter(status=200)
+
+        # copies keep their indexes
+        copied = copy.copy(calls)
+        assert len(copied.filter(host='other.com')) == 3
+        assert copied.count_route(None) == 1
+
+        # editing the calls keeps the indexes in sync
+        assert calls.pop().request.url == '/missing'
+        del calls[0]
+        calls.remove(calls.last(host='other.com'))
+        assert [call.request.url for call in calls.filter(method='GET')] == [
+            '/users?page=1', '/users?page=2']
+        assert calls.count_route(('GET', '/users')) == 2
+        assert calls.count_route(None) == 0
+        calls.insert(0, copied[0])
+        calls.append(copied[-1])
+        calls.reverse()
+        assert calls.last(method='GET').request.url == '/users?page=0'
+        assert calls.filter(path='/missing') == [copied[-1]]
+        # without their route
+        assert calls.count_route(None) == 2
+        assert len(copied) == 7
+        with pytest.raises(TypeError):
+            calls[0] = copied[0]
+
+        # pickled with their indexes, when the responses can be
+        logged = CallList()
+        logged.add(Request('GET', '/a', None, {}, 'http', 'a.com', 80), 'ok',
+                   {'key': ('GET', '/a')})
+        loaded = pickle.loads(pickle.dumps(logged))
+        assert loaded == logged
+        assert loaded.count_route(('GET', '/a')) == 1
+
+        calls.clear()
+        assert calls.filter(method='GET') == []
+
+    run()
+    assert_reset()
+
+
+def test_call_queries_threads():
+    @responses.activate
+    def run():
+        responses.add(responses.GET, re.compile('/[ab]$'), body='test')
+
+        def fetch(path):
+            for _ in range(50):
+                requests.get('http://example.com' + path)
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(fetch, ['/a', '/b'] * 4))
+
+        calls = responses.calls
+        assert len(calls) == 400
+        assert set(call.request.url for call in calls.filter(path='/a')) == {
+            '/a'}
+        assert len(calls.filter(path='/b')) == 200
+
+    run()
+    assert_reset()
+
+
+def test_origin_routes():
+    @responses.activate
+    def run():
+        responses.add_callback(responses.POST, '/', host='other.com',
+                               callback=lambda request: (201, {}, 'created'))
+        responses.add(responses.GET, '/', body='api', host='api.example.com')
+        responses.add(responses.GET, '/', body='users',
+                      host='users.example.com', scheme='https')
+        responses.add(responses.GET, '/', body='admin',
+                      host='*.example.com', port=8080)
+        responses.add(responses.GET, re.compile(r'/v\d+/'), body='v',
+                      host='*.example.com')
+        responses.add(responses.GET, '/', body='any')
+
+        def get(url):
+            return requests.get(url).text
+
+        assert get('http://api.example.com/') == 'api'
+        assert get('http://API.example.com/') == 'api'
+        assert get('https://users.example.com/') == 'users'
+        assert get('http://users.example.com/') == 'any'
+        assert get('http://users.example.com:8080/') == 'admin'
+        assert get('http://example.com/') == 'any'
+        assert get('https://www.example.com/v2/') == 'v'
+        with pytest.raises(ConnectionError):
+            requests.get('http://example.org/v2/')
+
+        assert requests.post('http://other.com/').status_code == 201
+        with pytest.raises(ConnectionError):
+            requests.post('http://example.com/')
+        assert len(responses.calls.filter(host='users.example.com')) == 3
+
+        # the scoped routes are counted per origin
+        calls = responses.calls
+        count = calls.count_route
+        assert count(('GET', '/', 'api.example.com', None, None)) == 2
+        assert count(('GET', '/', 'API.example.com')) == 2
+        assert count(('GET', '/', 'users.example.com', 'https')) == 1
+        assert count(('GET', '/', '*.example.com', '*', 8080)) == 1
+        assert calls.count_route(('GET', '/')) == 2
+
+    run()
+    assert_reset()
+
+    scoped = Responses('requests.packages.urllib3', stats=True)
+    with scoped:
+        scoped.add(scoped.GET, '/', body='a', host='a.example.com')
+        scoped.add(scoped.GET, '/', body='b', host='b.example.com')
+        for url in ['http://a.example.com/'] * 2 + ['http://b.example.com/']:
+            requests.get(url)
+        stats = scoped.get_stats()
+    assert [(route['host'], route['calls']) for route in stats['routes']] == [
+        ('a.example.com', 2), ('b.example.com', 1)]
+    assert 'GET *://b.example.com:*/' in scoped.report()
+
+
+def test_callback_cache():
+    counter = {'calls': 0}
+
+    def request_callback(request):
+        counter['calls'] += 1
+        return (200, {'X-Call': str(counter['calls'])}, request.url)
+
+    @responses.activate
+    def run():
+        responses.add_callback(responses.GET, '/lru', request_callback,
+                               cache=True, cache_size=2)
+        responses.add_callback(responses.POST, '/body', request_callback,
+                               cache=True, cache_key=('url', 'body'))
+        responses.add_callback(responses.GET, '/host', request_callback,
+                               cache=True, cache_key=lambda r: r.host)
+        responses.add_callback(responses.GET, '/off', request_callback)
+
+        for url in ('/lru?a', '/lru?b', '/lru?a', '/lru?c', '/lru?b'):
+            resp = requests.get('http://example.com' + url)
+            assert resp.text == url
+        # /lru?b was evicted by /lru?c
+        assert counter['calls'] == 4
+        resp = requests.get('http://example.com/lru?c')
+        assert resp.headers['X-Call'] == '3'
+
+        assert requests.post('http://example.com/body', data='1').text == \
+            '/body'
+        requests.post('http://example.com/body', data='1')
+        requests.post('http://example.com/body', data='2')
+        assert counter['calls'] == 6
+
+        requests.get('http://a.com/host?x')
+        assert requests.get('http://a.com/host?y').text == '/host?x'
+        requests.get('http://example.com/off')
+        requests.get('http://example.com/off')
+        assert counter['calls'] == 9
+
+        # a streamed body is neither looked up nor stored
+        for _ in range(2):
+            requests.post('http://example.com/body',
+                          data=(chunk for chunk in [b'1']))
+        assert counter['calls'] == 11
+
+        info = responses.cache_info()
+        assert info[('GET', '/lru')] == (2, 4, 2, 2)
+        assert info[('POST', '/body')] == (1, 2, 128, 2)
+        assert info[('GET', '/host')] == (1, 1, 128, 1)
+        assert ('GET', '/off') not in info
+
+        with pytest.raises(ValueError):
+            responses.add_callback(responses.GET, '/', request_callback,
+                                   cache=True, cache_key=('path',))
+
+    run()
+    assert_reset()
+
+
+def test_capture_body():
+    def echo(request):
+        return (200, {}, request.body.read())
+
+    def chunks():
+        yield b'a' * 10
+        yield b'b' * 10
+
+    digest = BodyDigest(20, hashlib.sha256(b'a' * 10 + b'b' * 10).hexdigest())
+    http = PoolManager()
+    for capture, max_body, expected in [
+        ('full', None, b'a' * 10 + b'b' * 10),
+        ('full', 15, b'a' * 10 + b'b' * 5),
+        ('digest', None, digest),
+        ('off', None, None),
+    ]:
+        mock = Responses('requests.packages.urllib3', capture=capture,
+                         max_body=max_body)
+        with mock:
+            mock.add_callback(mock.POST, '/echo', echo)
+            mock.add(mock.POST, '/upload')
+            resp = http.request('POST', 'http://example.com/echo',
+                                body=chunks())
+            # the callback reads the streamed body from a file
+            assert resp.data == b'a' * 10 + b'b' * 10
+            http.request('POST', 'http://example.com/upload',
+                         body=BytesIO(b'a' * 10 + b'b' * 10))
+            http.request('POST', 'http://example.com/upload',
+                         body=b'a' * 10 + b'b' * 10)
+            with pytest.raises(ProtocolError):
+                http.request('POST', 'http://example.com/missing',
+                             body=chunks())
+            assert [call.request.body for call in mock.calls] == \
+                [expected] * 4
+
+    with pytest.raises(ValueError):
+        Responses('requests.packages.urllib3', capture='some')
+
+
+def test_capture_bytes_like_body():
+    http = PoolManager()
+    for capture, expected in [
+        ('full', None),
+        ('full', b'abc'),
+        ('digest', BodyDigest(3, hashlib.sha256(b'abc').hexdigest())),
+    ]:
+        mock = Responses('requests.packages.urllib3', capture=capture,
+                         max_body=3 if expected == b'abc' else None)
+        with mock:
+            mock.add_callback(mock.POST, '/echo',
+                              lambda request: (200, {}, bytes(request.body)))
+            for body in (bytearray(b'abc'), memoryview(b'abc')):
+                resp = http.request('POST', 'http://example.com/echo',
+                                    body=body)
+                assert resp.data == b'abc'
+            bodies = [call.request.body for call in mock.calls]
+            if expected is None:
+                # untouched by the default policy
+                assert bodies == [bytearray(b'abc'), memoryview(b'abc')]
+            else:
+                assert bodies == [expected, expected]
+
+
+def test_emulate_pools(monkeypatch):
+    pooled = Responses('requests.packages.urllib3', emulate_pools=True,
+                       latency=Latency(connect_delay=0.05))
+    assert Responses('requests.packages.urllib3').pool_stats() is None
+
+    with pooled:
+        pooled.add(pooled.GET, '/', body='test')
+
+        # preloaded bodies give the connection back at once
+        http = PoolManager(maxsize=2)
+        sleeps = []
+        monkeypatch.setattr(urllib3_mock.time, 'sleep', sleeps.append)
+        for _ in range(5):
+            assert http.request('GET', 'http://example.com/').data == b'test'
+        monkeypatch.undo()
+        # only the first request opens a connection
+        assert sleeps == [0.05]
+        stats, = pooled.pool_stats()
+        assert stats['host'] == 'example.com'
+        assert (stats['created'], stats['reused'], stats['in_use'],
+                stats['idle']) == (1, 4, 0, 1)
+        pool = http.connection_from_url('http://example.com/')
+        assert (pool.num_connections, pool.num_requests) == (1, 5)
+
+        # streamed bodies hold their connection until they are read
+        session = requests.Session()
+        resp1 = session.get('http://example.com/', stream=True)
+        resp2 = session.get('http://example.com/', stream=True)
+        resp1.content
+        resp2.content
+        session.get('http://example.com/')
+
+        # block=True: wait for a connection, up to pool_timeout
+        blocking = PoolManager(maxsize=1, block=True)
+        resp = blocking.request('GET', 'http://example.com/',
+                                preload_content=False)
+        with pytest.raises(EmptyPoolError):
+            blocking.request('GET', 'http://example.com/',
+                             preload_content=False, pool_timeout=0.01)
+        assert resp.read() == b'test'
+        resp = blocking.request('GET', 'http://example.com/',
+                                preload_content=False, pool_timeout=0.01)
+        resp.release_conn()
+
+        # block=False: extra connections are discarded when released
+        extra = PoolManager(maxsize=1)
+        resps = [extra.request('GET', 'http://example.com/',
+                               preload_content=False) for _ in range(3)]
+        for resp in resps:
+            resp.read()
+
+        stats = [entry for entry in pooled.pool_stats()]
+        assert len(stats) == 4
+        by_maxsize = dict(((entry['maxsize'], entry['block']), entry)
+                          for entry in stats)
+        assert by_maxsize[1, True]['exhausted'] == 1
+        assert by_maxsize[1, True]['waits'] == 1
+        assert by_maxsize[1, True]['reused'] == 1
+        assert by_maxsize[1, False]['created'] == 3
+        assert by_maxsize[1, False]['discarded'] == 2
+        assert by_maxsize[1, False]['max_in_use'] == 3
+        session_stats = by_maxsize[10, False]
+        assert (session_stats['created'], session_stats['reused'],
+                session_stats['idle']) == (2, 1, 2)
+        assert len(pooled.calls) == 14
+
+    assert pooled.pool_stats() == []
+
+
+def test_record_off():
+    silent = Responses('requests.packages.urllib3', record='off')
+    with silent:
+        silent.add(silent.GET, '/', body='test')
+        assert_response(requests.get('http://example.com/'), 'test')
+        assert len(silent.calls) == 0
+        assert list(silent.calls) == []
+
+    with pytest.raises(ValueError):
+        Responses('requests.packages.urllib3', record='some')
+
+
+def test_threadsafe_stress():
+    concurrent = Responses('requests.packages.urllib3', threadsafe=True)
+    http = PoolManager(maxsize=32)
+
+    def register():
+        for i in range(500):
+            concurrent.add(concurrent.GET, '/extra/{0}'.format(i))
+            if i % 50 == 0:
+                concurrent.add(concurrent.GET, re.compile(r'/x{0}'.format(i)))
+
+    def fetch(n):
+        for i in range(200):
+            resp = http.request('GET', 'http://example.com/{0}/{1}'.format(
+                n % 4, i))
+            assert resp.status == 200
+            assert resp.data == str(n % 4).encode()
+        return n
+
+    with concurrent:
+        for n in range(4):
+            concurrent.add(concurrent.GET, re.compile(r'/{0}/'.format(n)),
+                           body=str(n))
+        registrar = threading.Thread(target=register)
+        registrar.start()
+        try:
+            with ThreadPoolExecutor(max_workers=32) as executor:
+                assert sorted(executor.map(fetch, range(64))) == list(
+                    range(64))
+        finally:
+            registrar.join()
+
+        assert len(concurrent.calls) == 64 * 200
+        urls = [call.request.url for call in concurrent.calls]
+        assert len(set(urls)) == 4 * 200
+        assert len(concurrent.calls) == 64 * 200
+
+
+def test_isolated_concurrent_tasks():
+    isolated = Responses('requests.packages.urllib3', isolated=True)
+    isolated.add(isolated.GET, '/shared', body='shared')
+
+    async def scenario(name, barrier):
+        with isolated:
+            isolated.add(isolated.GET, '/', body=name)
+            await barrier.wait()
+            resp = await asyncio.to_thread(requests.get, 'http://example.com')
+            assert resp.text == name
+            await barrier.wait()
+            with pytest.raises(ConnectionError):
+                await asyncio.to_thread(requests.get,
+                                        'http://example.com/shared')
+            assert len(isolated.calls) == 2
+            assert len(isolated._urls) == 1
+        return name
+
+    async def run():
+        barrier = Barrier(3)
+        names = ['task{0}'.format(i) for i in range(3)]
+        results = await asyncio.gather(*[scenario(name, barrier)
+                                         for name in names])
+        assert results == names
+        resp = await asyncio.to_thread(requests.get,
+                                       'http://example.com/shared')
+        assert resp.text == 'shared'
+
+    class Barrier(object):
+        def __init__(self, parties):
+            self.parties = parties
+            self.count = 0
+            self.event = asyncio.Event()
+
+        async def wait(self):
+            self.count += 1
+            if self.count % self.parties == 0:
+                self.event.set()
+                self.event = asyncio.Event()
+            else:
+                await self.event.wait()
+
+    isolated.start()
+    try:
+        asyncio.run(run())
+    finally:
+        isolated.stop()
+    assert len(isolated._urls) == 1
+    assert len(isolated.calls) == 1
+
+
+def test_streaming_body():
+    produced = []
+
+    def generate():
+        for i in range(1000):
+            produced.append(i)
+            yield b'x' * 1024
+
+    def request_callback(request):
+        return (200, None, generate())
+
+    @responses.activate
+    def run():
+        responses.add_callback(responses.GET, '/big', request_callback)
+        responses.add(responses.GET, '/chunks', body=[b'a', 'b', b'c'])
+
+        resp = requests.get('http://example.com/big', stream=True)
+        chunks = resp.iter_content(chunk_size=1024)
+        assert next(chunks) == b'x' * 1024
+        assert len(produced) < 10
+        assert sum(len(chunk) for chunk in chunks) == 999 * 1024
+        assert len(produced) == 1000
+
+        for i in range(2):
+            resp = requests.get('http://example.com/chunks')
+            assert resp.content == b'abc'
+
+        resp = requests.get('http://example.com/chunks', stream=True)
+        assert resp.raw.read(2) == b'ab'
+        assert resp.raw.read(2) == b'c'
+
+    run()
+    assert_reset()
+
+
+def test_file_like_body():
+    @responses.activate
+    def run():
+        responses.add_callback(responses.GET, '/file',
+                               lambda request: (200, None, BytesIO(b'data')))
+        assert requests.get('http://example.com/file').content == b'data'
+        assert requests.get('http://example.com/file').content == b'data'
+
+        # a static route would serve an empty body after the first request
+        with pytest.raises(ValueError):
+            responses.add(responses.GET, '/once', body=BytesIO(b'data'))
+        with pytest.raises(ValueError):
+            responses.add(responses.GET, '/once', body=iter([b'data']))
+
+    run()
+    assert_reset()
+
+
+def test_file_body(tmpdir):
+    path = tmpdir.join('object.bin')
+    path.write_binary(bytes(range(256)) * 4)
+    empty = tmpdir.join('empty.bin')
+    empty.write_binary(b'')
+
+    @responses.activate
+    def run():
+        responses.add_file(responses.GET, '/object', str(path))
+        responses.add_file(responses.GET, '/empty', str(empty))
+
+        resp = requests.get('http://example.com/object')
+        assert resp.status_code == 200
+        assert resp.headers['Content-Type'] == 'application/octet-stream'
+        assert resp.headers['Content-Length'] == '1024'
+        assert resp.headers['Accept-Ranges'] == 'bytes'
+        assert resp.content == bytes(range(256)) * 4
+
+        resp = requests.get('http://example.com/object',
+                            headers={'Range': 'bytes=10-19'})
+        assert resp.status_code == 206
+        assert resp.reason == 'Partial Content'
+        assert resp.headers['Content-Range'] == 'bytes 10-19/1024'
+        assert resp.headers['Content-Length'] == '10'
+        assert resp.content == bytes(range(10, 20))
+
+        resp = requests.get('http://example.com/object',
+                            headers={'Range': 'bytes=1000-'})
+        assert resp.headers['Content-Range'] == 'bytes 1000-1023/1024'
+        assert resp.content == bytes(range(232, 256))
+
+        resp = requests.get('http://example.com/object',
+                            headers={'Range': 'bytes=-4'})
+        assert resp.content == bytes(range(252, 256))
+
+        resp = requests.get('http://example.com/object',
+                            headers={'Range': 'bytes=2000-'})
+        assert resp.status_code == 416
+        assert resp.headers['Content-Range'] == 'bytes */1024'
+        assert resp.content == b''
+
+        resp = requests.get('http://example.com/object',
+                            headers={'Range': 'bytes=0-1,5-6'})
+        assert resp.status_code == 200
+        assert len(resp.content) == 1024
+
+        # last before first: an invalid range, ignored
+        resp = requests.get('http://example.com/object',
+                            headers={'Range': 'bytes=5-2'})
+        assert resp.status_code == 200
+        assert len(resp.content) == 1024
+
+        resp = requests.get('http://example.com/empty')
+        assert resp.headers['Content-Length'] == '0'
+        assert resp.content == b''
+
+    run()
+    assert_reset()
+
+
+def test_latency_timeouts():
+    @responses.activate
+    def run():
+        responses.add(responses.GET, '/slow', body='slow',
+                      latency=Latency(delay=0.2))
+        responses.add(responses.GET, '/connect', body='connect',
+                      latency=Latency(connect_delay=0.2))
+
+        start = time.monotonic()
+        assert requests.get('http://example.com/slow').text == 'slow'
+        assert time.monotonic() - start >= 0.2
+
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            requests.get('http://example.com/slow', timeout=0.05)
+        assert len(responses.calls) == 2
+        assert 'Read timed out' in str(responses.calls[-1].response)
+
+        assert requests.get('http://example.com/connect',
+                            timeout=(1, 0.05)).text == 'connect'
+        with pytest.raises(requests.exceptions.ConnectTimeout):
+            requests.get('http://example.com/connect', timeout=(0.05, 1))
+
+        http = PoolManager(retries=2)
+        with pytest.raises(MaxRetryError) as exc:
+            http.request('GET', 'http://example.com/connect', timeout=0.01)
+        assert isinstance(exc.value.reason, ConnectTimeoutError)
+        assert len(responses.calls) == 4 + 3
+
+    run()
+    assert_reset()
+
+
+def test_latency_jitter_and_bandwidth(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(urllib3_mock.time, 'sleep', sleeps.append)
+
+    def run(seed):
+        shaped = Responses('requests.packages.urllib3',
+                           latency=Latency(delay=0.1, jitter=0.1), seed=seed)
+        with shaped:
+            shaped.add(shaped.GET, '/', body='test')
+            shaped.add(shaped.GET, '/fast', body='fast', latency=Latency())
+            for i in range(3):
+                assert requests.get('http://example.com/').text == 'test'
+            assert requests.get('http://example.com/fast').text == 'fast'
+        return sleeps[-3:]
+
+    first = run(seed=42)
+    assert len(sleeps) == 3
+    assert all(0.1 <= delay <= 0.2 for delay in first)
+    assert run(seed=42) == first
+    assert run(seed=7) != first
+
+    del sleeps[:]
+    monkeypatch.undo()
+
+    @responses.activate
+    def throttled():
+        responses.add(responses.GET, '/', body=b'x' * 2000,
+                      latency=Latency(bandwidth=20000))
+        start = time.monotonic()
+        assert len(requests.get('http://example.com/').content) == 2000
+        assert time.monotonic() - start >= 0.1
+
+        responses.add(responses.GET, '/stalled', body=b'x',
+                      latency=Latency(bandwidth=1))
+        resp = requests.get('http://example.com/stalled', stream=True,
+                            timeout=0.05)
+        with pytest.raises(requests.exceptions.ConnectionError):
+            resp.content
+
+    throttled()
+    assert_reset()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = 'path={0}'.format(self.path).encode()
+        if self.path == '/host':
+            body = self.headers['Host'].split(':')[0].encode()
+        self.send_response(200)
+        if self.path == '/gzip':
+            body = gzip.compress(b'compressed')
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'a=1')
+        self.send_header('Set-Cookie', 'b=2')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_record_and_replay(tmpdir, http_server):
+    cassette = str(tmpdir.join('api.cassette'))
+    recorder = Responses('requests.packages.urllib3')
+    recorder.record_to(cassette)
+    with recorder:
+        resp = requests.get(http_server + '/foo?x=1')
+        assert resp.text == 'path=/foo?x=1'
+        assert requests.get(http_server + '/gzip').text == 'compressed'
+        assert len(recorder.calls) == 2
+
+    replayer = Responses('requests.packages.urllib3')
+    with replayer:
+        replayer.replay(cassette, scoped=False)
+        assert len(replayer._urls) == 2
+        resp = requests.get('http://nowhere.invalid/foo?x=1')
+        assert resp.status_code == 200
+        assert resp.text == 'path=/foo?x=1'
+        assert resp.cookies['a'] == '1'
+        assert resp.cookies['b'] == '2'
+        assert requests.get('http://nowhere.invalid/gzip').text == 'compressed'
+        with pytest.raises(ConnectionError):
+            requests.get('http://nowhere.invalid/foo?x=2')
+
+    with pytest.raises(ValueError):
+        replayer.replay(__file__)
+
+    # the same path on two hosts
+    cassette = str(tmpdir.join('hosts.cassette'))
+    localhost = http_server.replace('127.0.0.1', 'localhost')
+    recorder.record_to(cassette)
+    with recorder:
+        assert requests.get(http_server + '/host').text == '127.0.0.1'
+        assert requests.get(localhost + '/host').text == 'localhost'
+
+    with replayer:
+        replayer.replay(cassette)
+        assert requests.get(localhost + '/host').text == 'localhost'
+        assert requests.get(http_server + '/host').text == '127.0.0.1'
+        with pytest.raises(ConnectionError):
+            requests.get('http://nowhere.invalid/host')
+
+
+def test_add_many():
+    @responses.activate
+    def run():
+        responses.add_many([
+            {'method': responses.GET, 'url': '/{0}'.format(i),
+             'body': str(i)} for i in range(100)
+        ] + [
+            {'method': responses.POST, 'url': '/',
+             'status': 201, 'content_type': 'application/json'},
+        ])
+        assert len(responses._urls) == 101
+        assert requests.get('http://example.com/42').text == '42'
+        resp = requests.post('http://example.com/')
+        assert resp.status_code == 201
+        assert resp.headers['Content-Type'] == 'application/json'
+
+    run()
+    assert_reset()
+
+
+def test_load_routes(tmpdir):
+    tmpdir.join('object.bin').write_binary(b'object')
+    manifest = tmpdir.join('routes.json')
+    manifest.write(json.dumps({'routes': [
+        {'method': 'GET', 'url': '/json', 'json': {'value': 1}},
+        {'method': 'GET', 'url': '/file', 'file': 'object.bin'},
+        {'method': 'GET', 'url': r'/users/\d+', 'regex': True,
+         'body': 'user', 'status': 404, 'headers': {'x-id': '1'}},
+    ]}))
+    table = load_routes(str(manifest))
+    assert len(table) == 3
+
+    for i in range(2):
+        with responses:
+            responses.add(responses.GET, '/json', body='first')
+            responses.attach(table)
+            responses.add(responses.GET, '/json', body='last')
+            responses.add(responses.GET, '/local', body='local')
+
+            assert requests.get('http://example.com/json').text == 'first'
+            assert requests.get('http://example.com/local').text == 'local'
+            assert requests.get('http://example.com/file').text == 'object'
+            resp = requests.get('http://example.com/users/12')
+            assert resp.status_code == 404
+            assert resp.headers['x-id'] == '1'
+            assert len(responses._urls) == 6
+        assert_reset()
+
+        with responses:
+            responses.attach(table)
+            resp = requests.get('http://example.com/json')
+            assert resp.json() == {'value': 1}
+            assert resp.headers['Content-Type'] == 'application/json'
+            assert len(responses._urls) == 3
+        assert_reset()
+
+    # a regex route on any method
+    anything = RouteTable()
+    anything.add(urllib3_mock._static_route(
+        responses.ANY, re.compile(r'/any/\d+'), body='any'))
+    with responses:
+        responses.attach(anything)
+        assert requests.post('http://example.com/any/1').text == 'any'
+    assert_reset()
+
+    with pytest.raises(TypeError):
+        table.add({'method': 'GET', 'url': '/'})
+
+    manifest.write(json.dumps([{'method': 'GET', 'url': '/', 'bdy': ''}]))
+    with pytest.raises(ValueError) as exc:
+        load_routes(str(manifest))
+    assert 'route #0: Unknown keys: bdy' in str(exc.value)
+
+
+def test_load_routes_yaml(tmpdir):
+    pytest.importorskip('yaml')
+    manifest = tmpdir.join('routes.yaml')
+    manifest.write(
+        '- method: GET\n'
+        '  url: /?page=1\n'
+        '  match_querystring: true\n'
+        '  body: page one\n'
+    )
+
+    @responses.activate
+    def run():
+        responses.attach(load_routes(str(manifest)))
+        assert requests.get('http://example.com/?page=1').text == 'page one'
+        with pytest.raises(ConnectionError):
+            requests.get('http://example.com/?page=2')
+
+    run()
+    assert_reset()
+
+
+def test_hooks_and_stats():
+    events = []
+    reports = []
+    instrumented = Responses('requests.packages.urllib3', stats=True)
+    instrumented.add_hook('match', lambda request, route, seconds: (
+        events.append(('match', request.url, route and route['url'],
+                       seconds >= 0))))
+    instrumented.add_hook('callback', lambda request, route, seconds: (
+        events.append(('callback', request.url))))
+    instrumented.add_hook('response', lambda request, route, response: (
+        events.append(('response', request.url, response.status))))
+    instrumented.add_hook('error', lambda request, route, exc: (
+        events.append(('error', request.url, type(exc).__name__))))
+    instrumented.add_hook('stop', reports.append)
+    with pytest.raises(ValueError):
+        instrumented.add_hook('unknown', None)
+
+    with instrumented:
+        instrumented.add(instrumented.GET, '/', body=b'x' * 100)
+        instrumented.add_callback(instrumented.GET, re.compile('/cb'),
+                                  lambda request: (200, None, 'callback'))
+        instrumented.add(instrumented.GET, '/error', body=HTTPError('boom'))
+        for i in range(3):
+            assert len(requests.get('http://example.com/').content) == 100
+        assert requests.get('http://example.com/cb').text == 'callback'
+        with pytest.raises(HTTPError):
+            requests.get('http://example.com/error')
+        with pytest.raises(ConnectionError):
+            requests.get('http://example.com/missing')
+        assert reports == []
+
+    assert events[:2] == [('match', '/', '/', True), ('response', '/', 200)]
+    assert ('callback', '/cb') in events
+    assert ('error', '/error', 'HTTPError') in events
+    assert ('match', '/missing', None, True) in events
+
+    assert len(reports) == 1
+    stats = instrumented.get_stats()
+    assert reports[0] == stats
+    assert [(route['method'], route['url'], route['calls'], route['bytes'])
+            for route in stats['routes']] == [
+        ('GET', '/', 3, 300), ('GET', '/cb', 1, 8), ('GET', '/error', 1, 0)]
+    assert stats['routes'][0]['match_time']['count'] == 3
+    assert stats['routes'][1]['callback_time']['count'] == 1
+    assert stats['routes'][2]['errors'] == 1
+    assert stats['unmatched']['calls'] == 1
+    assert 'GET /cb' in instrumented.report()
+
+    instrumented.reset_stats()
+    assert instrumented.get_stats() == {'routes': [], 'unmatched': None}
+    assert Responses('requests.packages.urllib3').get_stats() is None
+
+
+def test_persistent_activation():
+    from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+    real_urlopen = HTTPConnectionPool.urlopen
+    outer = Responses('requests.packages.urllib3', persistent=True)
+    inner = Responses('requests.packages.urllib3', persistent=True)
+
+    try:
+        with outer:
+            outer.add(outer.GET, '/', body='outer')
+            installed = HTTPConnectionPool.urlopen
+            assert installed is not real_urlopen
+            assert requests.get('http://example.com').text == 'outer'
+
+            with inner:
+                inner.add(inner.GET, '/', body='inner')
+                with inner:
+                    assert requests.get('http://example.com').text == 'inner'
+                # still active, but the routes were reset
+                with pytest.raises(ConnectionError):
+                    requests.get('http://example.com')
+                assert len(inner.calls) == 1
+            assert requests.get('http://example.com').text == 'outer'
+            assert len(outer.calls) == 2
+            assert len(inner.calls) == 0
+
+        assert HTTPConnectionPool.urlopen is installed
+        with pytest.raises(ConnectionError):
+            requests.get('http://127.0.0.1:1')
+
+        for i in range(3):
+            with outer:
+                outer.add(outer.GET, '/', body=str(i))
+                assert requests.get('http://example.com').text == str(i)
+                with responses:
+                    responses.add(responses.GET, '/', body='mock.patch')
+                    resp = requests.get('http://example.com')
+                    assert resp.text == 'mock.patch'
+        assert_reset()
+    finally:
+        urllib3_mock.uninstall()
+    assert HTTPConnectionPool.urlopen is real_urlopen
+
+
+def test_mixed_activation():
+    from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+    real_urlopen = HTTPConnectionPool.urlopen
+    plain = Responses('requests.packages.urllib3')
+    persistent = Responses('requests.packages.urllib3', persistent=True)
+
+    try:
+        # the plain Responses stops first: the persistent one stays active
+        plain.start()
+        persistent.start()
+        persistent.add(persistent.GET, '/', body='persistent')
+        plain.stop()
+        assert requests.get('http://example.com').text == 'persistent'
+        persistent.stop()
+        persistent.reset()
+
+        # a plain Responses started within a persistent one
+        with persistent:
+            with plain:
+                plain.add(plain.GET, '/', body='plain')
+                assert requests.get('http://example.com').text == 'plain'
+            with pytest.raises(ConnectionError):
+                requests.get('http://example.com')
+        assert len(plain.calls) == 0
+    finally:
+        urllib3_mock.uninstall()
+    assert HTTPConnectionPool.urlopen is real_urlopen
+
+    # without a persistent Responses, the last stop() restores urlopen
+    with plain:
+        assert HTTPConnectionPool.urlopen is not real_urlopen
+    assert HTTPConnectionPool.urlopen is real_urlopen
+
+
+def test_multiple_packages(tmpdir, monkeypatch):
+    # a vendored copy with its own connection pool class
+    vendored = tmpdir.mkdir('vendored_urllib3')
+    vendored.join('__init__.py').write('')
+    vendored.mkdir('util').join('__init__.py').write('')
+    for name in ('response', 'exceptions', 'util/retry'):
+        module = name.replace('/', '.')
+        vendored.join(name + '.py').write(
+            'from urllib3.%s import *  # noqa\n' % module)
+    vendored.join('connectionpool.py').write(
+        'import urllib3.connectionpool\n\n\n'
+        'class HTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):'
+        '\n    pass\n')
+    monkeypatch.syspath_prepend(str(tmpdir))
+
+    # nothing is imported until the first start()
+    missing = Responses('no_such_urllib3')
+    with pytest.raises(ImportError):
+        missing.start()
+    assert not missing._active
+
+    multi = Responses(['urllib3', 'requests.packages.urllib3',
+                       'vendored_urllib3'])
+    from vendored_urllib3.connectionpool import HTTPConnectionPool
+    real_urlopen = HTTPConnectionPool.urlopen
+
+    with multi:
+        multi.add(multi.GET, '/', body='test')
+        resp = HTTPConnectionPool('example.com').urlopen('GET', '/')
+        assert resp.data == b'test'
+        assert requests.get('http://example.com').text == 'test'
+        assert len(multi.calls) == 2
+        # urllib3 and requests.packages.urllib3 are the same package
+        assert len(multi._apis) == 2
+
+    assert HTTPConnectionPool.urlopen is real_urlopen
+
+
+def test_pytest_plugin(pytester):
+    pytester.makeini("""
+        [pytest]
+        urllib3_mock_routes =
+            routes/api.json
+    """)
+    pytester.mkdir('routes')
+    pytester.path.joinpath('routes', 'api.json').write_text(json.dumps([
+        {'method': 'GET', 'url': '/ping', 'body': 'pong'},
+        {'method': 'GET', 'url': r'/users/\d+$', 'regex': True,
+         'body': '{}', 'content_type': 'application/json'},
+    ]))
+    pytester.makepyfile("""
+        import pytest
+        import requests
+
+        def test_shared(urllib3_mock, urllib3_mock_routes):
+            assert len(urllib3_mock_routes) == 1
+            assert urllib3_mock_routes[0].frozen
+            assert requests.get('http://example.com/ping').text == 'pong'
+            resp = requests.get('http://example.com/users/42')
+            assert resp.json() == {}
+            assert len(urllib3_mock.calls) == 2
+
+        def test_own_routes(urllib3_mock):
+            urllib3_mock.add('GET', '/ping', body='overridden')
+            urllib3_mock.add('GET', '/extra', body='extra')
+            assert requests.get('http://example.com/ping').text == 'pong'
+            assert requests.get('http://example.com/extra').text == 'extra'
+            assert len(urllib3_mock.calls) == 2
+
+        @pytest.mark.urllib3_mock(record='counters')
+        def test_marker(urllib3_mock, urllib3_mock_routes):
+            requests.get('http://example.com/ping')
+            assert urllib3_mock.calls.total == 1
+            # the session tables are not modified by the tests
+            assert len(urllib3_mock_routes[0]) == 2
+            with pytest.raises(TypeError):
+                urllib3_mock_routes[0].add_many([])
+    """)
+    try:
+        result = pytester.runpytest('-p', 'pytest_urllib3_mock')
+    finally:
+        urllib3_mock.uninstall()
+    result.assert_outcomes(passed=3)
+
+
+def test_serve(caplog):
+    served = Responses('requests.packages.urllib3', threadsafe=True)
+    served.add(served.GET, '/', body='test', adding_headers={'X-Test': '1'})
+    served.add(served.GET, '/big', body=b'x' * 200000)
+    served.add_callback(served.POST, '/echo',
+                        lambda request: (201, {}, request.body))
+    served.add_callback(served.GET, '/bug', lambda request: 1 / 0)
+
+    with served.serve() as server:
+        # another process
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import urllib.request; '
+            'print(urllib.request.urlopen(%r).read().decode())' %
+            (server.url + '/',)])
+        assert output.strip() == b'test'
+
+        # several requests on a keep-alive connection
+        conn = HTTPConnection(server.host, server.port)
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        assert (resp.status, resp.getheader('X-Test')) == (200, '1')
+        assert resp.read() == b'test'
+        conn.request('GET', '/big')
+        resp = conn.getresponse()
+        assert resp.getheader('Transfer-Encoding') == 'chunked'
+        assert resp.read() == b'x' * 200000
+        conn.request('POST', '/echo', body=b'payload')
+        assert conn.getresponse().read() == b'payload'
+        # unmatched: the connection is dropped
+        conn.request('GET', '/missing')
+        with pytest.raises(RemoteDisconnected):
+            conn.getresponse()
+        conn.close()
+
+        def fetch(i):
+            conn = HTTPConnection(server.host, server.port)
+            for _ in range(10):
+                conn.request('GET', '/')
+                assert conn.getresponse().read() == b'test'
+            conn.close()
+
+        with ThreadPoolExecutor(20) as executor:
+            list(executor.map(fetch, range(50)))
+
+        # a failing callback gets a 500, and is logged
+        http = PoolManager()
+        resp = http.request('GET', server.url + '/bug')
+        assert resp.status == 500
+        assert b'ZeroDivisionError' in resp.data
+        assert 'GET /bug' in caplog.text
+        # this connection is still open when the server closes
+
+    # without asyncio reporting the connection tasks
+    assert not [record for record in caplog.records
+                if record.name == 'asyncio']
+    calls = served.calls
+    assert len(calls) == 505
+    assert calls[0].request.host == '127.0.0.1'
+    assert calls[3].request.body == b'payload'
+    assert calls.count_route(None) == 1
+
+
+def test_serve_emulate_pools():
+    # the served pools are not emulated, hence never exhausted
+    served = Responses('requests.packages.urllib3', threadsafe=True,
+                       emulate_pools=True)
+    served.add(served.GET, '/', body='test')
+
+    with served.serve() as server:
+        conn = HTTPConnection(server.host, server.port)
+        for _ in range(3):
+            conn.request('GET', '/')
+            assert conn.getresponse().read() == b'test'
+        conn.close()
+
+    assert len(served.calls) == 3
+    assert served.pool_stats() == []
+
+
+def _fetch_many(count):
+    for i in range(count):
+        requests.get('http://example.com/?i={0}'.format(i))
+    with pytest.raises(ConnectionError):
+        requests.get('http://example.com/missing')
+    return count
+
+
+def test_multiprocess_calls():
+    multi = Responses('requests.packages.urllib3', multiprocess=True)
+    with multi:
+        multi.add(multi.GET, '/', body='test')
+        requests.get('http://example.com/')
+        # the children inherit the patched urlopen
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(4, mp_context=context) as executor:
+            assert sum(executor.map(_fetch_many, [500] * 4)) == 2000
+
+        calls = multi.calls
+        assert len(calls) == 2005
+        assert calls.count_route(('GET', '/')) == 2001
+        assert calls.count_route(None) == 4
+        remote = calls.last(path='/')
+        assert isinstance(remote.response, RemoteResponse)
+        assert remote.response.status == 200
+        assert remote.request.host == 'example.com'
+        assert isinstance(calls[-1].response, ProtocolError)
+    assert len(multi.calls) == 0
+
+
+def test_multiprocess_cleanup():
+    def threads():
+        return [thread for thread in threading.enumerate()
+                if thread.name == 'urllib3_mock.calls']
+
+    fds = len(os.listdir('/proc/self/fd'))
+    for i in range(3):
+        multi = Responses('requests.packages.urllib3', multiprocess=True)
+        with multi:
+            with multi:
+                assert len(threads()) == 1
+            multi.add(multi.GET, '/', body='test')
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                assert executor.submit(_fetch_many, 3).result() == 3
+            assert len(multi.calls) == 4
+        # the thread and the pipes end with the last stop()
+        assert threads() == []
+    assert len(os.listdir('/proc/self/fd')) == fds
+
+
+def test_multiprocess_calls_live_pool():
+    multi = Responses('requests.packages.urllib3', multiprocess=True)
+    with multi:
+        multi.add(multi.GET, '/', body='test')
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(2, mp_context=context) as executor:
+            assert executor.submit(_fetch_many, 10).result() == 10
+            # the batch is sent while the worker is idle, not at its exit
+            deadline = time.time() + 10
+            while len(multi.calls) < 11 and time.time() < deadline:
+                time.sleep(0.01)
+            assert len(multi.calls) == 11
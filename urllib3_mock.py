@@ -1,5 +1,25 @@
+import atexit
+import contextvars
+import fnmatch
+import functools
+import hashlib
+import importlib
 import inspect
-from collections import namedtuple
+import io
+import itertools
+import json
+import logging
+import os
+import pickle
+import random
+import re
+import socket
+import struct
+import threading
+import time
+import traceback
+import weakref
+from collections import Counter, OrderedDict, deque, namedtuple
 from functools import (
     wraps,
 )
@@ -8,7 +28,6 @@ from http.client import responses as http_reasons
 from io import BytesIO
 from urllib.parse import urlparse, parse_qsl
 
-_exec = getattr(__import__('builtins'), 'exec')
 unicode = str
 
 from unittest import mock
@@ -16,12 +35,150 @@ from unittest import mock
 Call = namedtuple('Call', ['request', 'response'])
 Request = namedtuple('Request', ['method', 'url', 'body', 'headers',
                                  'scheme', 'host', 'port'])
-_urllib3_import = """\
-from %(package)s.response import HTTPResponse
-from %(package)s.exceptions import ProtocolError
-"""
+_Template = namedtuple('_Template', ['status', 'reason', 'headers', 'body'])
+Latency = namedtuple('Latency', ['connect_delay', 'delay', 'jitter',
+                                 'bandwidth'])
+Latency.__new__.__defaults__ = (0, 0, 0, None)
+_ServedPool = namedtuple('_ServedPool', ['scheme', 'host', 'port'])
+_Urllib3 = namedtuple('_Urllib3', ['HTTPResponse', 'ProtocolError',
+                                   'ConnectTimeoutError', 'ReadTimeoutError',
+                                   'EmptyPoolError', 'Retry',
+                                   'HTTPConnectionPool'])
 
-__all__ = ['Responses']
+RemoteResponse = namedtuple('RemoteResponse', ['status', 'reason',
+                                               'headers'])
+BodyDigest = namedtuple('BodyDigest', ['length', 'sha256'])
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize',
+                                     'currsize'])
+
+_HOOK_EVENTS = ('match', 'callback', 'response', 'error', 'stop')
+
+__all__ = ['BodyDigest', 'CacheInfo', 'Latency', 'RemoteResponse', 'Responses',
+           'RouteTable', 'load_routes', 'uninstall']
+
+_DEFAULT_TIMEOUT = object()
+_log = logging.getLogger('urllib3_mock')
+
+# Streamed request bodies spill to disk past this size
+_SPOOL_SIZE = 1024 * 1024
+_BUFFER_TYPES = (bytes, bytearray, memoryview, unicode)
+_SERVE_CHUNK = 64 * 1024
+_ANY_ORIGIN = (None, None, None)
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+# Cassette trailer: offset of the JSON index, magic
+_CASSETTE_TRAILER = struct.Struct('>Q8s')
+_CASSETTE_MAGIC = b'u3mock01'
+
+_SCOPED_FLAGS = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'))
+# Numbered backreferences, conditionals and global inline flags do not
+# survive being embedded in a larger alternation.
+_NOT_COMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+
+def _import_urllib3(package):
+    def load(name):
+        return importlib.import_module(package + name)
+    exceptions = load('.exceptions')
+    return _Urllib3(
+        load('.response').HTTPResponse,
+        exceptions.ProtocolError,
+        exceptions.ConnectTimeoutError,
+        exceptions.ReadTimeoutError,
+        exceptions.EmptyPoolError,
+        load('.util.retry').Retry,
+        load('.connectionpool').HTTPConnectionPool,
+    )
+
+
+class _Interceptor(object):
+    # Replace HTTPConnectionPool.urlopen once, then dispatch to the last
+    # started handler, or to the real urlopen when there is none. It stays
+    # installed once a persistent Responses used it.
+
+    def __init__(self, pool_class):
+        self.pool_class = pool_class
+        self.original = _real_urlopen(pool_class)
+        # a subclass may inherit urlopen
+        self.inherited = 'urlopen' not in pool_class.__dict__
+        self.handlers = []
+        self.persistent = False
+        handlers, original = self.handlers, self.original
+
+        def urlopen(pool, method, url, body=None, headers=None, **kwargs):
+            return (handlers[-1] if handlers else original)(
+                pool, method, url, body=body, headers=headers, **kwargs)
+        self.urlopen = urlopen
+        self.install()
+
+    def install(self):
+        # Also reinstall if another patch restored the real urlopen
+        if self.pool_class.__dict__.get('urlopen') is not self.urlopen:
+            self.pool_class.urlopen = self.urlopen
+
+    def push(self, handler):
+        self.handlers.append(handler)
+
+    def remove(self, handler):
+        for index in range(len(self.handlers) - 1, -1, -1):
+            if self.handlers[index] == handler:
+                del self.handlers[index]
+                return
+
+    def uninstall(self):
+        del self.handlers[:]
+        if self.inherited:
+            if 'urlopen' in self.pool_class.__dict__:
+                del self.pool_class.urlopen
+        else:
+            self.pool_class.urlopen = self.original
+
+
+_interceptors = {}
+_interceptors_lock = threading.Lock()
+
+
+def _real_urlopen(pool_class):
+    # Skip the interceptors installed on the base classes
+    for klass in pool_class.__mro__:
+        urlopen = klass.__dict__.get('urlopen')
+        if urlopen is None:
+            continue
+        interceptor = _interceptors.get(klass)
+        if interceptor is not None and urlopen is interceptor.urlopen:
+            return interceptor.original
+        return urlopen
+
+
+def _install(pool_class, handler, persistent):
+    with _interceptors_lock:
+        try:
+            interceptor = _interceptors[pool_class]
+        except KeyError:
+            interceptor = _interceptors[pool_class] = _Interceptor(pool_class)
+        interceptor.install()
+        interceptor.push(handler)
+        if persistent:
+            interceptor.persistent = True
+        return interceptor
+
+
+def _release(interceptor, handler):
+    # Restore the real urlopen when no Responses needs the interceptor
+    with _interceptors_lock:
+        interceptor.remove(handler)
+        pool_class = interceptor.pool_class
+        if not (interceptor.handlers or interceptor.persistent) and \
+           _interceptors.get(pool_class) is interceptor:
+            del _interceptors[pool_class]
+            interceptor.uninstall()
+
+
+@atexit.register
+def uninstall():
+    # Restore the real urlopen patched by the persistent Responses
+    with _interceptors_lock:
+        while _interceptors:
+            _interceptors.popitem()[1].uninstall()
 
 
 def get_wrapped(func, responses):
@@ -39,27 +196,1458 @@ def get_wrapped(func, responses):
     return wrapper
 
 
-class _FakeHeaders(list):
+def _make_template(status, adding_headers, body, content_type):
+    # body must be bytes
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    elif not body:
+        body = b''
+
+    if hasattr(status, 'split'):
+        status, reason = status.split(None, 1)
+        status = int(status)
+    else:
+        reason = http_reasons.get(status)
+
+    headers = [
+        ('Content-Type', content_type),
+    ]
+    if adding_headers:
+        if hasattr(adding_headers, 'items'):
+            adding_headers = adding_headers.items()
+        for key, value in adding_headers:
+            if key.lower() == 'content-type':
+                if headers[0][0].lower() == 'content-type':
+                    del headers[0]  # No duplicate content_type
+            headers.append((key, value))
+
+    return _Template(status, reason, _FakeHeaders(headers), body)
+
+
+def _request_key(fields):
+    unknown = set(fields) - set(Request._fields)
+    if unknown:
+        raise ValueError('Unknown request fields: %s' %
+                         ', '.join(sorted(unknown)))
+
+    def key(request):
+        values = []
+        for field in fields:
+            value = getattr(request, field)
+            if field == 'body' and value is not None and \
+               not isinstance(value, (bytes, unicode)):
+                # A streamed body is read by the callback: never cached
+                raise TypeError('Streamed body')
+            if field == 'headers' and value is not None:
+                value = frozenset((name.lower(), item)
+                                  for (name, item) in value.items())
+            values.append(value)
+        return tuple(values)
+    return key
+
+
+class _CallbackCache(object):
+    # Templates built by a callback, by request key, least recently used
+    # first
+
+    def __init__(self, key=('method', 'url'), maxsize=128):
+        self.key = key if callable(key) else _request_key(tuple(key))
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def template(self, request, build):
+        try:
+            key = self.key(request)
+            hash(key)
+        except TypeError:  # a streamed body, or an unhashable key
+            return build()
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+        template = build()
+        if isinstance(template.body, bytes):
+            with self._lock:
+                self._templates[key] = template
+                if self.maxsize is not None and \
+                   len(self._templates) > self.maxsize:
+                    self._templates.popitem(last=False)
+        return template
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._templates))
+
+    def clear(self):
+        with self._lock:
+            self.hits = self.misses = 0
+            self._templates.clear()
+
+
+def _is_buffer(body):
+    # str, bytes or any bytes-like object, sent in one piece by urllib3
+    if isinstance(body, _BUFFER_TYPES):
+        return True
+    try:
+        memoryview(body)
+    except TypeError:
+        return False
+    return True
+
+
+def _iter_body(body):
+    if _is_buffer(body):
+        yield body
+    elif hasattr(body, 'read'):
+        while True:
+            chunk = body.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
+
+
+class _IterStream(io.RawIOBase):
+    # Serve an iterable of chunks lazily, as a file-like object
+
+    def __init__(self, iterable):
+        self._iter = iter(iterable)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk:
+            try:
+                chunk = next(self._iter)
+            except StopIteration:
+                return 0
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            self._chunk = memoryview(chunk)
+        size = min(len(b), len(self._chunk))
+        b[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def _body_stream(body):
+    if isinstance(body, memoryview):
+        return _IterStream((body,))  # no copy of the whole buffer
+    if isinstance(body, (bytes, bytearray)):
+        return BytesIO(body)
+    if hasattr(body, 'read'):
+        return body
+    return _IterStream(body)
+
+
+class _ThrottledStream(io.RawIOBase):
+    # Cap the rate at which the body is read, in bytes per second
+
+    def __init__(self, stream, bandwidth, read_timeout=None):
+        self._stream = stream
+        self._bandwidth = float(bandwidth)
+        self._read_timeout = read_timeout
+        self._started = None
+        self._sent = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._started is None:
+            self._started = time.monotonic()
+        if (self._read_timeout is not None and
+                1 / self._bandwidth > self._read_timeout):
+            time.sleep(self._read_timeout)
+            raise socket.timeout('timed out')
+        data = self._stream.read(len(b))
+        size = len(data)
+        b[:size] = data
+        self._sent += size
+        wait = self._started + self._sent / self._bandwidth - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        return size
+
+
+def _get_timeouts(pool, timeout):
+    # Return the (connect, read) timeouts in seconds, or None
+    if not (timeout is None or isinstance(timeout, (int, float)) or
+            hasattr(timeout, 'read_timeout')):
+        timeout = getattr(pool, 'timeout', None)  # default timeout
+    if hasattr(timeout, 'read_timeout'):
+        timeouts = (timeout.connect_timeout, timeout.read_timeout)
+    else:
+        timeouts = (timeout, timeout)
+    return tuple(value if isinstance(value, (int, float)) else None
+                 for value in timeouts)
+
+
+def _get_header(headers, name):
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value
+
+
+def _parse_range(value, size):
+    # Return (first, last) for a single byte range, None when the header
+    # should be ignored and False when the range is not satisfiable.
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    try:
+        if not first:
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first = int(first)
+            if last and int(last) < first:
+                return None  # invalid, hence ignored
+            last = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if not sep or first < 0:
+        return None
+    if first >= size or first > last:
+        return False
+    return first, last
+
+
+class _MappedFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self._view = None
+        self._headers = None
+
+    @property
+    def view(self):
+        if self._view is None:
+            if not self.size:  # an empty file cannot be mapped
+                self._view = memoryview(b'')
+            else:
+                import mmap
+                with open(self.path, 'rb') as f:
+                    self._view = memoryview(
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._view
+
+    def template(self, route, request):
+        template, size = route['template'], self.size
+        headers = template.headers + (('Accept-Ranges', 'bytes'),)
+        byte_range = None
+        if template.status == 200:
+            value = _get_header(request.headers, 'range')
+            byte_range = value and _parse_range(value, size)
+
+        if byte_range is False:
+            return _Template(416, http_reasons[416], _FakeHeaders(headers + (
+                ('Content-Range', 'bytes */%d' % size),
+                ('Content-Length', '0'),
+            )), b'')
+        if byte_range:
+            first, last = byte_range
+            return _Template(206, http_reasons[206], _FakeHeaders(headers + (
+                ('Content-Range', 'bytes %d-%d/%d' % (first, last, size)),
+                ('Content-Length', str(last - first + 1)),
+            )), self.view[first:last + 1])
+        if self._headers is None:
+            self._headers = _FakeHeaders(
+                headers + (('Content-Length', str(size)),))
+        return template._replace(headers=self._headers, body=self.view)
+
+
+class _CassetteEntry(object):
+
+    def __init__(self, mapped, offset, length):
+        self.mapped = mapped
+        self.offset = offset
+        self.length = length
+
+    def template(self, route, request):
+        start = self.offset
+        return route['template']._replace(
+            body=self.mapped.view[start:start + self.length])
+
+
+class _CassetteWriter(object):
+    # The bodies are written as they are recorded, then the JSON index
+    # and the trailer pointing to it.
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._index = []
+        self._lock = threading.Lock()
+
+    def add(self, request, status, reason, headers, body):
+        with self._lock:
+            self._index.append({
+                'method': request.method,
+                'url': request.url,
+                'scheme': request.scheme,
+                'host': request.host,
+                'port': request.port,
+                'status': status,
+                'reason': reason,
+                'headers': headers,
+                'offset': self._file.tell(),
+                'length': len(body),
+            })
+            self._file.write(body)
+
+    def close(self):
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(json.dumps(self._index).encode('utf-8'))
+            self._file.write(_CASSETTE_TRAILER.pack(offset, _CASSETTE_MAGIC))
+            self._file.close()
+
+
+def _read_cassette_index(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < _CASSETTE_TRAILER.size:
+            raise ValueError('Not a cassette: %s' % (path,))
+        f.seek(-_CASSETTE_TRAILER.size, os.SEEK_END)
+        offset, magic = _CASSETTE_TRAILER.unpack(f.read())
+        if magic != _CASSETTE_MAGIC:
+            raise ValueError('Not a cassette: %s' % (path,))
+        f.seek(offset)
+        return json.loads(f.read()[:-_CASSETTE_TRAILER.size].decode('utf-8'))
+
+
+def _header_items(headers):
+    # Keep the repeated headers, like Set-Cookie, as separate items
+    return list(getattr(headers, 'iteritems', headers.items)())
+
+
+class _FakeHeaders(tuple):
+    # Immutable (name, value) pairs, with the values indexed by lower case
+    # name; built once per template and shared by its responses.
+
+    def __new__(cls, headers=()):
+        self = tuple.__new__(cls, headers)
+        index = {}
+        for (name, value) in self:
+            index.setdefault(name.lower(), []).append(value)
+        self._index = dict((name, tuple(values))
+                           for (name, values) in index.items())
+        return self
+
     def get_all(self, key, default=None):
-        key = key.lower()
-        return [v for (k, v) in self if k.lower() == key]
+        return list(self._index.get(key.lower(), ()))
     getheaders = get_all
 
 
 class _FakeResponse(object):
-    def __init__(self, headers):
-        self.msg = _FakeHeaders(headers)
+    def __init__(self, headers, stream=None):
+        if not isinstance(headers, _FakeHeaders):
+            headers = _FakeHeaders(headers)
+        self.msg = headers
+        self._stream = stream
 
     def isclosed(self):
-        return False
+        return self._stream is not None and self._stream.closed
+
+    def close(self):
+        pass
+
+
+def _route_key(method, url, host=None, scheme=None, port=None):
+    # (method, url), followed by the origin of a scoped route
+    key = tuple('*' if value is mock.ANY else value
+                for value in (method, url))
+    origin = _route_origin({'host': host, 'scheme': scheme, 'port': port})
+    return key if origin == _ANY_ORIGIN else key + origin
 
 
 class CallList(list):
+    # Calls indexed by method, host, path and route key, for the queries
+    _CRITERIA = ('method', 'host', 'path', 'route')
+
+    def __init__(self):
+        list.__init__(self)
+        self._lock = threading.Lock()
+        self._reindex([])
+
+    def add(self, request, response, route=None):
+        call = Call(request, response)
+        keys = _call_keys(request, route)
+        with self._lock:
+            position = len(self)
+            list.append(self, call)
+            self._keys.append(keys)
+            for name, key in zip(self._CRITERIA, keys):
+                self._index[name].setdefault(key, []).append(position)
+
+    # A Call appended like to a plain list has no route
+    def append(self, call):
+        self.add(call.request, call.response)
+
+    def extend(self, calls):
+        for call in calls:
+            self.append(call)
+
+    def __iadd__(self, calls):
+        self.extend(calls)
+        return self
+
+    def clear(self):
+        with self._lock:
+            list.clear(self)
+            self._reindex([])
+
+    # Moving calls shifts the positions: rebuild the indexes
+    def insert(self, position, call):
+        with self._lock:
+            list.insert(self, position, call)
+            self._keys.insert(position, _call_keys(call.request))
+            self._reindex(self._keys)
+
+    def __delitem__(self, position):
+        with self._lock:
+            list.__delitem__(self, position)
+            del self._keys[position]
+            self._reindex(self._keys)
+
+    def pop(self, position=-1):
+        with self._lock:
+            call = list.pop(self, position)
+            del self._keys[position]
+            self._reindex(self._keys)
+        return call
+
+    def remove(self, call):
+        del self[self.index(call)]
+
+    def reverse(self):
+        with self._lock:
+            list.reverse(self)
+            self._keys.reverse()
+            self._reindex(self._keys)
+
+    def _not_indexed(self, *args, **kwargs):
+        raise TypeError('The calls cannot be replaced or sorted in place')
+
+    __setitem__ = __imul__ = sort = _not_indexed
+
+    def __copy__(self):
+        return _rebuild_calls(list(self), list(self._keys))
+
+    def __reduce__(self):
+        return (_rebuild_calls, (list(self), list(self._keys)))
+
+    def _reindex(self, keys):
+        self._keys = keys
+        self._index = dict((name, {}) for name in self._CRITERIA)
+        for position, call_keys in enumerate(keys):
+            for name, key in zip(self._CRITERIA, call_keys):
+                self._index[name].setdefault(key, []).append(position)
 
-    def add(self, request, response):
+    def count_route(self, route):
+        # The calls matched by a route, or unmatched with None
+        return len(self._index['route'].get(self._lookup_route(route), ()))
+
+    def filter(self, **criteria):
+        with self._lock:
+            return [self[position] for position in self._find(criteria)]
+
+    def last(self, **criteria):
+        with self._lock:
+            for position in reversed(self._find(criteria)):
+                return self[position]
+
+    def _lookup_route(self, route):
+        if isinstance(route, dict):
+            return route['key']
+        return route if route is None else _route_key(*route)
+
+    def _find(self, criteria):
+        # Scan the shortest index, check the other criteria on the keys
+        checks = []
+        for name, value in criteria.items():
+            if name not in self._index:
+                raise TypeError('Unknown criterion: %s' % name)
+            if name == 'route':
+                value = self._lookup_route(value)
+            positions = self._index[name].get(value, [])
+            checks.append((positions, self._CRITERIA.index(name), value))
+        if not checks:
+            return range(len(self))
+        checks.sort(key=lambda check: len(check[0]))
+        positions, others = checks[0][0], checks[1:]
+        if not others:
+            return positions
+        keys = self._keys
+        return [position for position in positions
+                if all(keys[position][i] == value
+                       for (_, i, value) in others)]
+
+
+def _call_keys(request, route=None):
+    return (request.method, request.host, request.url.partition('?')[0],
+            route['key'] if route else None)
+
+
+def _rebuild_calls(calls, keys):
+    # Unpickle or copy a CallList with its indexes
+    rebuilt = CallList()
+    list.extend(rebuilt, calls)
+    rebuilt._reindex(keys)
+    return rebuilt
+
+
+class RecentCallList(deque):
+    # Only keep the last `maxlen` calls
+
+    def add(self, request, response, route=None):
         self.append(Call(request, response))
 
 
+class CallCounter(object):
+    # Count the calls per route and per status, without keeping them
+
+    def __init__(self):
+        self.total = 0
+        self.by_route = Counter()
+        self.by_status = Counter()
+
+    def __len__(self):
+        return self.total
+
+    def add(self, request, response, route=None):
+        self._count(*self._keys(response, route))
+
+    @staticmethod
+    def _keys(response, route):
+        return (route['key'] if route else None,
+                getattr(response, 'status', type(response).__name__))
+
+    def _count(self, route_key, status):
+        self.total += 1
+        self.by_route[route_key] += 1
+        self.by_status[status] += 1
+
+
+class NoCallList(tuple):
+
+    def add(self, request, response, route=None):
+        pass
+
+
+class _ThreadCallBuffer(object):
+    # Each thread appends to its own buffer; they are merged on demand,
+    # in call order, into the call list. With max_calls, a buffer only
+    # keeps the last calls of its thread.
+
+    def __init__(self, calls, maxlen=None):
+        self.calls = calls
+        self._maxlen = maxlen
+        self._local = threading.local()
+        self._buffers = []
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def add(self, request, response, route=None):
+        self._buffer().append((next(self._seq), request, response, route))
+
+    def merge(self):
+        with self._lock:
+            pending = self._drain()
+            pending.sort()
+            for seq, request, response, route in pending:
+                self.calls.add(request, response, route)
+        return self.calls
+
+    def _buffer(self):
+        try:
+            return self._local.buffer
+        except AttributeError:
+            buf = self._local.buffer = deque(maxlen=self._maxlen)
+            with self._lock:
+                self._buffers.append((threading.current_thread(), buf))
+            return buf
+
+    def _drain(self):
+        # The buffers of the finished threads are dropped once emptied
+        alive = [thread.is_alive() for (thread, buf) in self._buffers]
+        pending = []
+        for thread, buf in self._buffers:
+            # the owner thread may append meanwhile, never pop
+            for _ in range(len(buf)):
+                pending.append(buf.popleft())
+        self._buffers = [entry for (entry, keep) in
+                         zip(self._buffers, alive) if keep]
+        return pending
+
+
+class _ThreadCounterBuffer(_ThreadCallBuffer):
+    # Only buffer the keys counted by a CallCounter
+
+    def add(self, request, response, route=None):
+        self._buffer().append(self.calls._keys(response, route))
+
+    def merge(self):
+        with self._lock:
+            for keys in self._drain():
+                self.calls._count(*keys)
+        return self.calls
+
+
+def _combinable_pattern(regex):
+    if not isinstance(regex, re.Pattern):
+        return None
+    pattern = regex.pattern
+    if (not isinstance(pattern, unicode) or regex.groupindex or
+            regex.flags & (re.VERBOSE | re.ASCII | re.LOCALE) or
+            _NOT_COMBINABLE.search(pattern)):
+        return None
+    flags = ''.join(c for (flag, c) in _SCOPED_FLAGS if regex.flags & flag)
+    return '(?%s:%s)' % (flags, pattern) if flags else pattern
+
+
+def _compile_regex_routes(routes):
+    # Merge the patterns into one alternation where each route is followed
+    # by an empty named group: a single pass finds the first registered
+    # route that matches. Capturing the whole pattern instead would defeat
+    # the prefix optimizations of the regex engine.
+    parts, groups, single = [], {}, []
+    for route in routes:
+        pattern = _combinable_pattern(route['url'])
+        if pattern is None:
+            single.append(route)
+        else:
+            name = '_r%d' % len(parts)
+            groups[name] = route
+            parts.append('(?:%s)(?P<%s>)' % (pattern, name))
+    try:
+        combined = re.compile('|'.join(parts)).match if parts else None
+    except re.error:
+        combined, single = None, routes
+
+    def matcher(url):
+        best = None
+        if combined is not None:
+            found = combined(url)
+            if found:
+                best = groups[found.lastgroup]
+        for route in single:
+            if best is not None and route['order'] > best['order']:
+                break
+            if route['url'].match(url):
+                return route
+        return best
+    return matcher
+
+
+def _canonical_url(url):
+    parsed = urlparse(url)
+    return parsed[:3], tuple(sorted(parse_qsl(parsed.query)))
+
+
+def _earliest(route, other):
+    if route is None or (other is not None and
+                         other['order'] < route['order']):
+        return other
+    return route
+
+
+class _RouteIndex(object):
+    # The routes of one origin
+
+    def __init__(self):
+        # (method, path) -> first registered route
+        self._exact = {}
+        # (method, canonical URL) -> first registered match_querystring route
+        self._strict = {}
+        # regular expressions, with one combined matcher per method
+        self._regex = []
+        self._matchers = {}
+        # ANY URL or ANY method
+        self._fallback = []
+
+    def add(self, route):
+        method, url = route['method'], route['url']
+        if hasattr(url, 'match'):
+            self._regex.append(route)
+            self._matchers = {}
+        elif not (isinstance(method, unicode) and isinstance(url, unicode)):
+            self._fallback.append(route)
+        elif route['match_querystring']:
+            self._strict.setdefault((method, _canonical_url(url)), route)
+        else:
+            self._exact.setdefault((method, url), route)
+
+    def compile(self):
+        # ANY is not hashable, and matched on every method anyway
+        for method in set([route['method'] for route in self._regex
+                           if isinstance(route['method'], unicode)]):
+            self._match_regex(method, '')
+
+    def find(self, request):
+        best = self._exact.get((request.method,
+                                request.url.partition('?')[0]))
+        if self._strict:
+            best = _earliest(best, self._strict.get(
+                (request.method, _canonical_url(request.url))))
+        if self._regex:
+            best = _earliest(best, self._match_regex(request.method,
+                                                     request.url))
+        for match in self._fallback:
+            if best is not None and match['order'] > best['order']:
+                break
+            if request.method == match['method'] and \
+               self._has_url_match(match, request.url):
+                return match
+        return best
+
+    def _match_regex(self, method, url):
+        # A matcher built while a route is being added is stored in the
+        # discarded dict, never in the fresh one.
+        matchers = self._matchers
+        try:
+            matcher = matchers[method]
+        except KeyError:
+            routes = [r for r in self._regex if method == r['method']]
+            matcher = matchers[method] = _compile_regex_routes(routes)
+        return matcher(url)
+
+    def _has_url_match(self, match, request_url):
+        url = match['url']
+
+        if hasattr(url, 'match'):
+            return url.match(request_url)
+        if match['match_querystring']:
+            return self._has_strict_url_match(url, request_url)
+
+        return url == request_url.partition('?')[0]
+
+    def _has_strict_url_match(self, url, other):
+        return _canonical_url(url) == _canonical_url(other)
+
+
+def _route_origin(route):
+    # (host, scheme, port), where None matches any value
+    host, scheme, port = (None if value in (None, '*') else value
+                          for value in (route.get('host'),
+                                        route.get('scheme'),
+                                        route.get('port')))
+    return (host and host.lower(), scheme, port)
+
+
+class RouteTable(object):
+
+    def __init__(self):
+        self.routes = []
+        # (host, scheme, port) -> routes scoped to this origin
+        self._origins = {}
+        # wildcard host -> its matcher; request host -> candidate hosts
+        self._host_patterns = {}
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self.frozen = False
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add(self, route):
+        self.add_many((route,))
+
+    def add_many(self, routes):
+        with self._lock:
+            if self.frozen:
+                raise TypeError('Cannot add routes to a frozen RouteTable')
+            for route in routes:
+                self._add(route)
+
+    def freeze(self):
+        # Shared tables are read-only; build their matchers once
+        with self._lock:
+            self.frozen = True
+            for index in self._origins.values():
+                index.compile()
+        return self
+
+    def _add(self, route):
+        origin = _route_origin(route)
+        route['order'] = len(self.routes)
+        route['key'] = _route_key(route['method'], route['url'], *origin)
+        self.routes.append(route)
+        host = origin[0]
+        if host is not None and host not in self._host_patterns and \
+           any(char in host for char in '*?['):
+            self._host_patterns[host] = re.compile(
+                fnmatch.translate(host.lower())).match
+            self._hosts = {}
+        index = self._origins.get(origin)
+        if index is None:
+            index = self._origins[origin] = _RouteIndex()
+        index.add(route)
+
+    def find(self, request):
+        origins = self._origins
+        if len(origins) == 1 and _ANY_ORIGIN in origins:
+            return origins[_ANY_ORIGIN].find(request)
+        # Only the routes of the request origin, and the unscoped ones
+        ports = (request.port or _DEFAULT_PORTS.get(request.scheme), None)
+        best = None
+        for host in self._candidate_hosts(request.host):
+            for scheme in (request.scheme, None):
+                for port in ports:
+                    index = origins.get((host, scheme, port))
+                    if index is not None:
+                        best = _earliest(best, index.find(request))
+        return best
+
+    def _candidate_hosts(self, host):
+        hosts = self._hosts
+        try:
+            return hosts[host]
+        except KeyError:
+            folded = (host or '').lower()
+            candidates = hosts[host] = [folded] + [
+                pattern for pattern, match in self._host_patterns.items()
+                if match(folded)] + [None]
+            return candidates
+
+
+def _static_route(method, url, body='', match_querystring=False,
+                  status=200, adding_headers=None,
+                  content_type='text/plain', latency=None,
+                  host=None, scheme=None, port=None):
+    # The template is shared by every request: its body must be re-readable
+    if hasattr(body, 'read') or hasattr(body, '__next__'):
+        raise ValueError('A generator or file body can only be read once: '
+                         'return a new one from add_callback() instead')
+    return {
+        'url': url,
+        'method': method,
+        'host': host,
+        'scheme': scheme,
+        'port': port,
+        'template': _make_template(status, adding_headers, body,
+                                   content_type),
+        'content_type': content_type,
+        'match_querystring': match_querystring,
+        'latency': latency,
+    }
+
+
+def _file_route(method, url, path, match_querystring=False,
+                status=200, adding_headers=None,
+                content_type='application/octet-stream', latency=None,
+                host=None, scheme=None, port=None):
+    return {
+        'url': url,
+        'method': method,
+        'host': host,
+        'scheme': scheme,
+        'port': port,
+        'source': _MappedFile(path),
+        'template': _make_template(status, adding_headers, b'',
+                                   content_type),
+        'content_type': content_type,
+        'match_querystring': match_querystring,
+        'latency': latency,
+    }
+
+
+_MANIFEST_KEYS = frozenset([
+    'method', 'url', 'regex', 'body', 'json', 'file', 'status', 'headers',
+    'content_type', 'match_querystring', 'host', 'scheme', 'port',
+])
+
+
+def _manifest_route(entry, base_dir):
+    unknown = set(entry) - _MANIFEST_KEYS
+    if unknown:
+        raise ValueError('Unknown keys: %s' % ', '.join(sorted(unknown)))
+    if 'method' not in entry or 'url' not in entry:
+        raise ValueError('Both method and url are required')
+
+    url = entry['url']
+    if entry.get('regex'):
+        url = re.compile(url)
+    kwargs = {
+        'match_querystring': entry.get('match_querystring', False),
+        'status': entry.get('status', 200),
+        'adding_headers': entry.get('headers'),
+        'host': entry.get('host'),
+        'scheme': entry.get('scheme'),
+        'port': entry.get('port'),
+    }
+    if 'content_type' in entry:
+        kwargs['content_type'] = entry['content_type']
+    if 'file' in entry:
+        path = os.path.join(base_dir, entry['file'])
+        return _file_route(entry['method'], url, path, **kwargs)
+    body = entry.get('body', '')
+    if 'json' in entry:
+        body = json.dumps(entry['json'])
+        kwargs.setdefault('content_type', 'application/json')
+    return _static_route(entry['method'], url, body, **kwargs)
+
+
+def load_routes(path):
+    with open(path, 'rb') as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.loads(f.read().decode('utf-8'))
+    if isinstance(manifest, dict):
+        manifest = manifest.get('routes', ())
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    routes = []
+    for (index, entry) in enumerate(manifest):
+        try:
+            routes.append(_manifest_route(entry, base_dir))
+        except (ValueError, TypeError, re.error, OSError) as exc:
+            raise ValueError('%s: route #%d: %s' % (path, index, exc))
+    table = RouteTable()
+    table.add_many(routes)
+    return table
+
+
+class _Histogram(object):
+    # Timings in power of two buckets of microseconds
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = Counter()
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[1 << int(seconds * 1e6).bit_length()] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'buckets_us': dict(sorted(self.buckets.items())),
+        }
+
+
+class _RouteStats(object):
+
+    def __init__(self, route):
+        key = route['key'] if route else (None, None)
+        self.method, self.url = key[:2]
+        self.host, self.scheme, self.port = key[2:] or _ANY_ORIGIN
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.match = _Histogram()
+        self.callback = _Histogram()
+
+    def as_dict(self):
+        return {
+            'method': self.method,
+            'url': getattr(self.url, 'pattern', self.url),
+            'host': self.host,
+            'scheme': self.scheme,
+            'port': self.port,
+            'calls': self.calls,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'match_time': self.match.as_dict(),
+            'callback_time': self.callback.as_dict(),
+        }
+
+
+class _CountingStream(io.RawIOBase):
+
+    def __init__(self, stream, stats, lock):
+        self._stream = stream
+        self._stats = stats
+        self._lock = lock
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._stream.read(len(b))
+        size = len(data)
+        b[:size] = data
+        with self._lock:
+            self._stats.bytes += size
+        return size
+
+
+class _PoolState(object):
+    # Emulated connections of an HTTPConnectionPool: like urllib3, a LIFO
+    # queue of maxsize slots, None until a connection is opened.
+
+    def __init__(self, maxsize, block):
+        self.maxsize = maxsize
+        self.block = block
+        self._queue = [None] * maxsize
+        self._serial = itertools.count(1)
+        self._cond = threading.Condition()
+        self.created = self.reused = self.discarded = 0
+        self.waits = self.exhausted = 0
+        self.in_use = self.max_in_use = 0
+
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._queue and self.block:
+                self.waits += 1
+                if not self._cond.wait_for(lambda: self._queue, timeout):
+                    self.exhausted += 1
+                    return None
+            conn = self._queue.pop() if self._queue else None
+            new = conn is None
+            if new:
+                conn = next(self._serial)
+                self.created += 1
+            else:
+                self.reused += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return _Checkout(self, conn, new)
+
+    def _put_conn(self, checkout):
+        # Called by HTTPResponse.release_conn()
+        checkout.release()
+
+    def put(self, conn):
+        with self._cond:
+            self.in_use -= 1
+            if len(self._queue) < self.maxsize:
+                self._queue.append(conn)
+                self._cond.notify()
+            else:
+                self.discarded += 1
+
+    def as_dict(self):
+        with self._cond:
+            return {
+                'maxsize': self.maxsize,
+                'block': self.block,
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'waits': self.waits,
+                'exhausted': self.exhausted,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'idle': sum(1 for conn in self._queue if conn is not None),
+            }
+
+
+class _Checkout(object):
+    # A connection taken from an emulated pool, given back once
+
+    def __init__(self, state, conn, new):
+        self.state = state
+        self.conn = conn
+        self.new = new
+        self.closed = False
+        self.released = False
+
+    def close(self):
+        self.closed = True
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.state.put(None if self.closed else self.conn)
+
+
+def _drop_conn(conn):
+    # A failed request closes its connection
+    if conn is not None:
+        conn.close()
+        conn.release()
+
+
+class _ClosingStream(io.RawIOBase):
+    # Closed once read to the end, like http.client.HTTPResponse
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._stream.read(len(b))
+        size = len(data)
+        b[:size] = data
+        if not size and len(b):
+            self.close()
+        return size
+
+
+def _call_summary(request, response, route):
+    # A picklable copy of a call made in a child process
+    body = request.body
+    if not isinstance(body, (bytes, unicode, BodyDigest)):
+        body = None
+    headers = request.headers
+    if headers is not None:
+        headers = dict(headers)
+    if isinstance(response, Exception):
+        try:
+            pickle.loads(pickle.dumps(response))
+        except Exception:
+            response = RuntimeError(repr(response))
+    else:
+        response = RemoteResponse(response.status, response.reason,
+                                  dict(response.headers))
+    return (request._replace(body=body, headers=headers), response,
+            route and {'key': route['key']})
+
+
+class _CallChannel(object):
+    # Batches of calls made by forked children, sent over a pipe to the
+    # parent; a thread of the parent empties the pipe, so the children
+    # never block on it. A batch is sent when full, or `linger` seconds
+    # after its first call. The pipes and the thread only live from the
+    # first start() to the last stop().
+    batch_size = 256
+    linger = 0.05
+
+    def __init__(self):
+        import multiprocessing
+        self._pid = os.getpid()
+        self._reader = self._writer = self._wakeup = None
+        self._write_lock = multiprocessing.Lock()
+        self._read_lock = threading.Lock()
+        self._received = deque()
+        self._thread = None
+        # (pid, calls) not sent yet, in a child
+        self._pending = (self._pid, [])
+        self._pending_lock = threading.Lock()
+
+    @property
+    def in_child(self):
+        return os.getpid() != self._pid
+
+    def start(self):
+        import multiprocessing
+        with self._read_lock:
+            if self._thread is None and not self.in_child:
+                self._reader, self._writer = multiprocessing.Pipe(
+                    duplex=False)
+                # closed by stop() to end the thread
+                wakeup, self._wakeup = multiprocessing.Pipe(duplex=False)
+                self._thread = threading.Thread(
+                    target=self._drain_forever, args=(wakeup,),
+                    name='urllib3_mock.calls')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        if self.in_child:
+            return
+        with self._read_lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._wakeup.close()
+        thread.join()
+        with self._read_lock:
+            self._drain_pipe()
+            for conn in (self._reader, self._writer):
+                conn.close()
+            self._reader = self._writer = self._wakeup = None
+
+    def send(self, request, response, route):
+        call = _call_summary(request, response, route)
+        with self._pending_lock:
+            pid, pending = self._pending
+            if pid != os.getpid():
+                # First call in this child: send the rest at exit, and
+                # let the pipe break once the parent closes its end
+                import multiprocessing.util
+                if self._reader is not None:
+                    self._reader.close()
+                    self._reader = None
+                pending = []
+                self._pending = (os.getpid(), pending)
+                multiprocessing.util.Finalize(None, self.flush,
+                                              exitpriority=10)
+            pending.append(call)
+            if len(pending) == 1:
+                timer = threading.Timer(self.linger, self.flush)
+                timer.daemon = True
+                timer.start()
+            if len(pending) < self.batch_size:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._pending_lock:
+            pending = self._pending[1]
+            if not pending:
+                return
+            data = pickle.dumps(pending, pickle.HIGHEST_PROTOCOL)
+            del pending[:]
+        with self._write_lock:
+            try:
+                self._writer.send_bytes(data)
+            except (AttributeError, OSError):
+                pass  # the parent stopped listening
+
+    def receive(self):
+        self._drain()
+        calls = []
+        while self._received:
+            calls.extend(self._received.popleft())
+        return calls
+
+    def _drain(self):
+        with self._read_lock:
+            if self._reader is not None:
+                self._drain_pipe()
+
+    def _drain_pipe(self):
+        while self._reader.poll():
+            self._received.append(pickle.loads(self._reader.recv_bytes()))
+
+    def _drain_forever(self, wakeup):
+        import multiprocessing.connection
+        reader = self._reader
+        while wakeup not in multiprocessing.connection.wait([reader, wakeup]):
+            self._drain()
+        wakeup.close()
+
+
+class _ProcessCallLog(object):
+    # In forked children, the calls go to the parent
+
+    def __init__(self, log, channel):
+        self.log = log
+        self.channel = channel
+
+    def add(self, request, response, route=None):
+        if self.channel.in_child:
+            self.channel.send(request, response, route)
+        else:
+            self.log.add(request, response, route)
+
+    def merge(self):
+        for call in self.channel.receive():
+            self.log.add(*call)
+        if hasattr(self.log, 'merge'):
+            self.log.merge()
+
+
+class _Registry(object):
+    # Routes and call log; bound to the current context in isolated mode.
+    # New routes go to the last table; attached tables are shared.
+    token = None
+
+    @property
+    def routes(self):
+        return self.tables[-1]
+
+
+class _Server(object):
+    # A localhost HTTP/1.1 server answering with the routes of a Responses,
+    # on an asyncio loop in a background thread. Matching, callbacks and
+    # delays run in the loop executor. asyncio is only imported here.
+
+    def __init__(self, handle, api, host, port):
+        import asyncio
+        self._handle = handle
+        self._api = api
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._writers = set()
+        self._started = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(host, port),
+                                        name='urllib3_mock.serve')
+        self._thread.daemon = True
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            self._thread.join()
+            raise self._error
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+        self.url = 'http://%s:%d' % (self.host, self.port)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self, host, port):
+        import asyncio
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        try:
+            self._server = loop.run_until_complete(asyncio.start_server(
+                self._serve, host, port, backlog=4096))
+        except OSError as exc:
+            self._error = exc
+        self._started.set()
+        if self._error is None:
+            loop.run_forever()
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+    def close(self):
+        if self._thread is None:
+            return
+        import asyncio
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    async def _shutdown(self):
+        # Closing the connections ends their tasks at the next read or
+        # write; cancelled tasks would be reported by asyncio.
+        import asyncio
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _serve(self, reader, writer):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await self._read_request(reader, writer)
+                if request is None:
+                    break
+                method, target, headers, body, keep_alive = request
+                # Without a response, drop the connection, like a refused
+                # connection would do.
+                first = await loop.run_in_executor(
+                    None, self._respond, method, target, headers, body)
+                if first is None:
+                    break
+                response, chunk = first
+                keep_alive = await self._write_response(
+                    loop, writer, method, response, chunk, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, version = line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip()] = value.strip()
+
+        if (_get_header(headers, 'expect') or '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if 'chunked' in (_get_header(headers, 'transfer-encoding') or ''):
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass  # trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        else:
+            length = int(_get_header(headers, 'content-length') or 0)
+            body = (await reader.readexactly(length)) if length else None
+
+        connection = (_get_header(headers, 'connection') or '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+        return method, target, headers, body, keep_alive
+
+    def _respond(self, method, target, headers, body):
+        if '://' in target:  # absolute form, as sent to a proxy
+            target = '/' + target.split('://', 1)[1].partition('/')[2]
+        host, _, port = (_get_header(headers, 'host') or '').rpartition(':')
+        if not host or not port.isdigit():
+            host, port = _get_header(headers, 'host') or self.host, None
+        pool = _ServedPool('http', host, int(port) if port else None)
+        try:
+            response = self._handle(pool, method, target, body=body,
+                                    headers=headers)
+            return response, response.read(_SERVE_CHUNK, decode_content=False)
+        except self._api.ProtocolError:  # unmatched
+            return None
+        except Exception:
+            # e.g. a failing callback
+            error = traceback.format_exc()
+            _log.error('Error serving %s %s\n%s', method, target, error)
+            body = error.encode('utf-8')
+            response = self._api.HTTPResponse(
+                body=BytesIO(body), status=500,
+                reason='Internal Server Error',
+                headers={'Content-Type': 'text/plain; charset=utf-8'},
+                preload_content=False)
+            return response, response.read(_SERVE_CHUNK)
+
+    async def _write_response(self, loop, writer, method, response, chunk,
+                              keep_alive):
+        more = len(chunk) == _SERVE_CHUNK
+        headers = [(name, value) for (name, value) in response.headers.items()
+                   if name.lower() not in ('connection', 'content-length',
+                                           'transfer-encoding')]
+        if more:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        else:
+            headers.append(('Content-Length', str(len(chunk))))
+        if not keep_alive:
+            headers.append(('Connection', 'close'))
+        lines = ['HTTP/1.1 %d %s' % (response.status, response.reason or '')]
+        lines.extend('%s: %s' % header for header in headers)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if method == 'HEAD':
+            pass
+        elif not more:
+            writer.write(chunk)
+        else:
+            while chunk:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                await writer.drain()
+                chunk = await loop.run_in_executor(None, functools.partial(
+                    response.read, _SERVE_CHUNK, decode_content=False))
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        response.release_conn()
+        return keep_alive
+
+
 class Responses(object):
     ANY = mock.ANY
     DELETE = 'DELETE'
@@ -70,151 +1658,615 @@ class Responses(object):
     POST = 'POST'
     PUT = 'PUT'
 
-    def __init__(self, package='urllib3'):
-        evaldict = {}
-        _exec(_urllib3_import % {'package': package}, evaldict)
-
-        self._package = package
+    def __init__(self, package='urllib3', record='full', max_calls=None,
+                 threadsafe=False, isolated=False, latency=None, seed=None,
+                 stats=False, persistent=False, capture='full',
+                 max_body=None, multiprocess=False, emulate_pools=False):
+        if record not in ('full', 'counters', 'off'):
+            raise ValueError('Unknown recording policy: %r' % (record,))
+        if capture not in ('full', 'digest', 'off'):
+            raise ValueError('Unknown capture policy: %r' % (capture,))
+        if isinstance(package, unicode):
+            package = (package,)
+        # One or several urllib3 installations, imported on first use
+        self._packages = tuple(package)
+        self._urllib3 = None
         self._request_class = Request
-        self._response_class = evaldict['HTTPResponse']
-        self._error_class = evaldict['ProtocolError']
+        self._latency = latency
+        self._random = random.Random(seed)
+        self._recorder = None
+        self._record = record
+        self._max_calls = max_calls
+        # Request bodies recorded in the calls: all or the first max_body
+        # bytes, a BodyDigest, or nothing
+        self._capture = capture
+        self._max_body = max_body
+        self._capture_all = capture == 'full' and max_body is None
+        self._threadsafe = threadsafe
+        self._context = None
+        if isolated:
+            self._context = contextvars.ContextVar('urllib3_mock.registry')
+        self._persistent = persistent
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._default = _Registry()
+        self._hooks = dict((event, []) for event in _HOOK_EVENTS)
+        self._stats = {} if stats else None
+        self._stats_lock = threading.Lock()
+        self._instrumented = stats
+        # Collect the calls of the forked child processes
+        self._channel = _CallChannel() if multiprocess else None
+        # Emulated connections of each HTTPConnectionPool
+        self._pools = weakref.WeakKeyDictionary() if emulate_pools else None
+        self._pools_lock = threading.Lock()
         self.reset()
 
+    @property
+    def _apis(self):
+        if self._urllib3 is None:
+            apis = []
+            for package in self._packages:
+                api = _import_urllib3(package)
+                # e.g. requests.packages.urllib3 may be urllib3 itself
+                if all(api.HTTPConnectionPool is not other.HTTPConnectionPool
+                       for other in apis):
+                    apis.append(api)
+            self._urllib3 = apis
+        return self._urllib3
+
+    @property
+    def _registry(self):
+        if self._context is None:
+            return self._default
+        return self._context.get(self._default)
+
     def reset(self):
-        self._urls = []
-        self._calls = CallList()
+        self._reset_registry(self._registry)
+        if self._pools is not None:
+            with self._pools_lock:
+                self._pools.clear()
+
+    def _reset_registry(self, registry):
+        registry.tables = [RouteTable()]
+        registry.calls = self._new_call_list()
+        if not self._threadsafe or self._record == 'off':
+            registry.log = registry.calls
+        elif self._record == 'counters':
+            registry.log = _ThreadCounterBuffer(registry.calls)
+        else:
+            registry.log = _ThreadCallBuffer(registry.calls, self._max_calls)
+        if self._channel is not None:
+            registry.log = _ProcessCallLog(registry.log, self._channel)
+        return registry
+
+    def _new_call_list(self):
+        if self._record == 'counters':
+            return CallCounter()
+        if self._record == 'off':
+            return NoCallList()
+        if self._max_calls is not None:
+            return RecentCallList(maxlen=self._max_calls)
+        return CallList()
 
     def add(self, method, url, body='', match_querystring=False,
             status=200, adding_headers=None,
-            content_type='text/plain'):
+            content_type='text/plain', latency=None,
+            host=None, scheme=None, port=None):
 
-        # body must be bytes
-        if isinstance(body, unicode):
-            body = body.encode('utf-8')
+        self._registry.routes.add(_static_route(
+            method, url, body, match_querystring, status, adding_headers,
+            content_type, latency, host, scheme, port))
 
-        self._urls.append({
-            'url': url,
-            'method': method,
-            'return': (status, adding_headers, body),
-            'content_type': content_type,
-            'match_querystring': match_querystring,
-        })
+    def add_many(self, routes):
+        # Each route is a dict of arguments for add()
+        self._registry.routes.add_many(
+            [_static_route(**route) for route in routes])
 
     def add_callback(self, method, url, callback, match_querystring=False,
-                     content_type='text/plain'):
+                     content_type='text/plain', latency=None,
+                     host=None, scheme=None, port=None, cache=False,
+                     cache_key=('method', 'url'), cache_size=128):
+        # With cache=True, the response built by the callback is reused
+        # for the requests with the same cache_key: some Request fields,
+        # or a function of the request.
+        if cache:
+            cache = _CallbackCache(cache_key, cache_size)
 
-        self._urls.append({
+        self._registry.routes.add({
             'url': url,
             'method': method,
+            'host': host,
+            'scheme': scheme,
+            'port': port,
             'callback': callback,
+            'cache': cache or None,
             'content_type': content_type,
             'match_querystring': match_querystring,
+            'latency': latency,
         })
 
+    def add_file(self, method, url, path, match_querystring=False,
+                 status=200, adding_headers=None,
+                 content_type='application/octet-stream', latency=None,
+                 host=None, scheme=None, port=None):
+
+        self._registry.routes.add(_file_route(
+            method, url, path, match_querystring, status, adding_headers,
+            content_type, latency, host, scheme, port))
+
+    def attach(self, table):
+        # Share a prebuilt RouteTable; its routes come after the routes
+        # already added and before the routes added later.
+        tables = self._registry.tables
+        if not tables[-1]:
+            tables.pop()
+        tables.extend((table.freeze(), RouteTable()))
+
+    def record_to(self, path):
+        # Until the last stop(), pass the requests through to the real
+        # urlopen and record them in the cassette.
+        self._recorder = _CassetteWriter(path)
+
+    def replay(self, path, scoped=True):
+        # With scoped=False, the responses are replayed for any origin
+        mapped = _MappedFile(path)
+        routes = self._registry.routes
+        for entry in _read_cassette_index(path):
+            routes.add({
+                'url': entry['url'],
+                'method': entry['method'],
+                'host': entry['host'] if scoped else None,
+                'scheme': entry['scheme'] if scoped else None,
+                'port': entry['port'] if scoped else None,
+                'source': _CassetteEntry(mapped, entry['offset'],
+                                         entry['length']),
+                'template': _Template(
+                    entry['status'], entry['reason'],
+                    _FakeHeaders(map(tuple, entry['headers'])), b''),
+                'content_type': None,
+                'match_querystring': True,
+                'latency': None,
+            })
+
+    def serve(self, host='127.0.0.1', port=0):
+        # Answer with the same routes over HTTP, for other processes and
+        # clients; the calls are recorded as usual. Returns the running
+        # server, with its url; close() stops it.
+        api, context = self._apis[0], contextvars.copy_context()
+
+        def handle(pool, method, url, **kwargs):
+            # In the registry of the caller, even in isolated mode
+            return context.copy().run(self._handle, api, pool, method, url,
+                                      **kwargs)
+        return _Server(handle, api, host, port)
+
+    def add_hook(self, event, func):
+        # match: func(request, route, seconds), route is None if unmatched
+        # callback: func(request, route, seconds)
+        # response: func(request, route, response)
+        # error: func(request, route, exception), for exception bodies
+        #     and timeouts
+        # stop: func(stats), on the last stop()
+        if event not in self._hooks:
+            raise ValueError('Unknown hook event: %r' % (event,))
+        self._hooks[event].append(func)
+        self._instrumented = True
+
+    def pool_stats(self):
+        # Emulated connections, for each pool
+        if self._pools is None:
+            return None
+        with self._pools_lock:
+            pools = list(self._pools.items())
+        stats = []
+        for pool, state in pools:
+            entry = {'scheme': pool.scheme, 'host': pool.host,
+                     'port': pool.port}
+            entry.update(state.as_dict())
+            stats.append(entry)
+        return stats
+
+    def cache_info(self):
+        # CacheInfo of the cached callbacks, by route key
+        return dict((route['key'], route['cache'].info())
+                    for table in self._registry.tables
+                    for route in table.routes if route.get('cache'))
+
+    def get_stats(self):
+        if self._stats is None:
+            return None
+        with self._stats_lock:
+            routes = [stats.as_dict() for (key, stats) in
+                      self._stats.items() if key is not None]
+            unmatched = self._stats.get(None)
+        routes.sort(key=lambda stats: -stats['calls'])
+        return {
+            'routes': routes,
+            'unmatched': unmatched.as_dict() if unmatched else None,
+        }
+
+    def reset_stats(self):
+        if self._stats is not None:
+            with self._stats_lock:
+                self._stats.clear()
+
+    def report(self):
+        stats = self.get_stats()
+        if stats is None:
+            return ''
+        lines = ['%8s %10s %10s %12s  %s' % (
+            'calls', 'match us', 'callbk us', 'bytes', 'route')]
+        for entry in stats['routes'] + [stats['unmatched'] or {}]:
+            if not entry:
+                continue
+            origin = ''
+            if entry['host'] or entry['scheme'] or entry['port']:
+                origin = '%s://%s:%s' % tuple(
+                    entry[name] or '*' for name in ('scheme', 'host', 'port'))
+            lines.append('%8d %10.1f %10.1f %12d  %s %s%s' % (
+                entry['calls'], entry['match_time']['mean'] * 1e6,
+                entry['callback_time']['mean'] * 1e6, entry['bytes'],
+                entry['method'] or '-', origin,
+                entry['url'] or '(unmatched)'))
+        return '\n'.join(lines)
+
+    def _route_stats(self, route):
+        key = route['key'] if route else None
+        try:
+            return self._stats[key]
+        except KeyError:
+            return self._stats.setdefault(key, _RouteStats(route))
+
+    def _observe(self, event, request, route, value):
+        for func in self._hooks[event]:
+            func(request, route, value)
+        if self._stats is None:
+            return
+        with self._stats_lock:
+            stats = self._route_stats(route)
+            if event == 'match':
+                stats.calls += 1
+                stats.match.add(value)
+                if route is None:
+                    stats.errors += 1
+            elif event == 'callback':
+                stats.callback.add(value)
+            elif event == 'error':
+                stats.errors += 1
+
+    @property
+    def _urls(self):
+        return [route for table in self._registry.tables
+                for route in table.routes]
+
     @property
     def calls(self):
-        return self._calls
+        registry = self._registry
+        if registry.log is not registry.calls:
+            registry.log.merge()
+        return registry.calls
 
     def __enter__(self):
+        if self._context is not None:
+            registry = self._reset_registry(_Registry())
+            registry.token = self._context.set(registry)
         self.start()
         return self
 
     def __exit__(self, *args):
         self.stop()
-        self.reset()
+        if self._context is not None:
+            self._context.reset(self._context.get().token)
+        else:
+            self.reset()
 
     def activate(self, func):
         return get_wrapped(func, self)
 
-    def _find_match(self, request):
-        for match in self._urls:
-            if request.method == match['method'] and \
-               self._has_url_match(match, request.url):
+    def _find_match(self, request, registry=None):
+        for table in (registry or self._registry).tables:
+            match = table.find(request)
+            if match is not None:
                 return match
 
-    def _has_url_match(self, match, request_url):
-        url = match['url']
-
-        if hasattr(url, 'match'):
-            return url.match(request_url)
-        if match['match_querystring']:
-            return self._has_strict_url_match(url, request_url)
-
-        return url == request_url.partition('?')[0]
-
-    def _has_strict_url_match(self, url, other):
-        url_parsed = urlparse(url)
-        other_parsed = urlparse(other)
-
-        if url_parsed[:3] != other_parsed[:3]:
-            return False
-
-        url_qsl = sorted(parse_qsl(url_parsed.query))
-        other_qsl = sorted(parse_qsl(other_parsed.query))
-        return url_qsl == other_qsl
-
     def _urlopen(self, pool, method, url, body=None, headers=None, **kwargs):
+        return self._handle(self._apis[0], pool, method, url, body=body,
+                            headers=headers, **kwargs)
+
+    def _handle(self, api, pool, method, url, body=None, headers=None,
+                **kwargs):
+        registry = self._registry
+        log = registry.log
         request = self._request_class(method, url, body, headers,
                                       pool.scheme, pool.host, pool.port)
-        match = self._find_match(request)
+        instrumented = self._instrumented
+        if instrumented:
+            started = time.perf_counter()
+            match = self._find_match(request, registry)
+            self._observe('match', request, match,
+                          time.perf_counter() - started)
+        else:
+            match = self._find_match(request, registry)
+
+        logged = request
+        if body is not None and not (self._capture_all and
+                                     isinstance(body, _BUFFER_TYPES)):
+            request, logged = self._capture_body(request, match)
 
         if match is None:
             error_msg = 'Connection refused: {0} {1}'.format(request.method,
                                                              request.url)
-            response = self._error_class(error_msg)
+            response = api.ProtocolError(error_msg)
 
-            self._calls.add(request, response)
+            log.add(logged, response)
             raise response
 
-        headers = [
-            ('Content-Type', match['content_type']),
-        ]
+        state = self._pool_state(pool)
+        if state is None:
+            return self._respond(api, pool, method, url, body, headers,
+                                 kwargs, request, logged, match, None)
+        conn = self._get_conn(pool, state, kwargs.get('pool_timeout'))
+        if conn is None:
+            error = api.EmptyPoolError(
+                pool, "Pool is empty and a new connection can't be opened "
+                "due to blocking mode.")
+            log.add(logged, error, match)
+            raise error
+        try:
+            return self._respond(api, pool, method, url, body, headers,
+                                 kwargs, request, logged, match, conn)
+        except BaseException:
+            _drop_conn(conn)
+            raise
+
+    def _pool_state(self, pool):
+        # None when the pools, or this pool, are not emulated
+        if self._pools is None:
+            return None
+        try:
+            with self._pools_lock:
+                state = self._pools.get(pool)
+                if state is None:
+                    maxsize = getattr(getattr(pool, 'pool', None),
+                                      'maxsize', 1)
+                    state = self._pools[pool] = _PoolState(
+                        maxsize or 1, getattr(pool, 'block', False))
+        except TypeError:  # not weakly referenceable
+            return None
+        return state
+
+    def _get_conn(self, pool, state, timeout):
+        # None when the pool is exhausted
+        conn = state.get(timeout)
+        # Like urllib3, count on the pool itself
+        if conn is not None and hasattr(pool, 'num_requests'):
+            pool.num_requests += 1
+            pool.num_connections += conn.new
+        return conn
+
+    def _respond(self, api, pool, method, url, body, headers, kwargs,
+                 request, logged, match, conn):
+        log = self._registry.log
+        instrumented = self._instrumented
+        latency = match['latency'] or self._latency
+        if latency:
+            connect_timeout, read_timeout = _get_timeouts(
+                pool, kwargs.get('timeout', _DEFAULT_TIMEOUT))
+            # With emulated pools, only a new connection is delayed
+            if latency.connect_delay and (conn is None or conn.new):
+                if (connect_timeout is not None and
+                        latency.connect_delay > connect_timeout):
+                    time.sleep(connect_timeout)
+                    error = api.ConnectTimeoutError(
+                        pool, 'Connection to {0} timed out. (connect '
+                        'timeout={1})'.format(pool.host, connect_timeout))
+                    _drop_conn(conn)
+                    return self._timeout(api, pool, method, url, body,
+                                         headers, kwargs, logged, match,
+                                         error)
+                time.sleep(latency.connect_delay)
 
         if 'callback' in match:  # use callback
-            status, r_headers, body = match['callback'](request)
-            if isinstance(body, unicode):
-                body = body.encode('utf-8')
+            if match['cache'] is None:
+                template = self._call_back(request, match)
+            else:
+                template = match['cache'].template(request, functools.partial(
+                    self._call_back, request, match))
+        elif 'source' in match:  # file or cassette
+            template = match['source'].template(match, request)
         else:
-            status, r_headers, body = match['return']
+            template = match['template']
 
-        if isinstance(body, Exception):
-            self._calls.add(request, body)
-            raise body
+        if isinstance(template.body, Exception):
+            if instrumented:
+                self._observe('error', request, match, template.body)
+            log.add(logged, template.body, match)
+            raise template.body
 
-        if hasattr(status, 'split'):
-            status, reason = status.split(None, 1)
-            status = int(status)
-        else:
-            reason = http_reasons.get(status)
-
-        if r_headers:
-            if hasattr(r_headers, 'items'):
-                r_headers = r_headers.items()
-            for key, value in r_headers:
-                if key.lower() == 'content-type':
-                    if headers[0][0].lower() == 'content-type':
-                        del headers[0]  # No duplicate content_type
-                headers.append((key, value))
-
-        response = self._response_class(
-            status=status,
-            reason=reason,
-            body=BytesIO(body) if body else BytesIO(),
-            headers=headers,
+        stream = _body_stream(template.body)
+        if self._stats is not None:
+            with self._stats_lock:
+                stats = self._route_stats(match)
+            stream = _CountingStream(stream, stats, self._stats_lock)
+        if latency:
+            delay = latency.delay
+            if latency.jitter:
+                delay += self._random.uniform(0, latency.jitter)
+            if read_timeout is not None and delay > read_timeout:
+                time.sleep(read_timeout)
+                error = api.ReadTimeoutError(
+                    pool, url,
+                    'Read timed out. (read timeout={0})'.format(read_timeout))
+                _drop_conn(conn)
+                return self._timeout(api, pool, method, url, body, headers,
+                                     kwargs, logged, match, error)
+            if delay:
+                time.sleep(delay)
+            if latency.bandwidth:
+                stream = _ThrottledStream(stream, latency.bandwidth,
+                                          read_timeout)
+
+        pool_state = None
+        if conn is not None:
+            # Like urllib3, keep the connection until the body is read,
+            # unless the content is preloaded
+            release = kwargs.get('release_conn')
+            if release is None:
+                release = kwargs.get('preload_content', True)
+            if release:
+                conn.release()
+                conn = None
+            else:
+                pool_state = conn.state
+                stream = _ClosingStream(stream)
+
+        response = api.HTTPResponse(
+            status=template.status,
+            reason=template.reason,
+            body=stream,
+            headers=template.headers,
             preload_content=False,
-            original_response=_FakeResponse(headers),
+            original_response=_FakeResponse(template.headers, stream),
+            pool=pool_state,
+            connection=conn,
         )
 
-        self._calls.add(request, response)
+        if instrumented:
+            for func in self._hooks['response']:
+                func(request, match, response)
+        log.add(logged, response, match)
+        return response
+
+    def _capture_body(self, request, match):
+        # Consume the body once, keeping what the policy records; a
+        # streamed body is spooled for the callback.
+        body = request.body
+        full = self._capture == 'full'
+        room = self._max_body
+        digest = hashlib.sha256() if self._capture == 'digest' else None
+        streamed = not _is_buffer(body)
+        spool = None
+        if streamed and not self._capture_all and \
+           match is not None and 'callback' in match:
+            import tempfile
+            spool = tempfile.SpooledTemporaryFile(_SPOOL_SIZE)
+        length, kept = 0, []
+        for chunk in _iter_body(body):
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            elif not isinstance(chunk, bytes):
+                chunk = bytes(chunk)
+            length += len(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            elif full and room is None:
+                kept.append(chunk)
+            elif full and room > 0:
+                kept.append(chunk[:room])
+                room -= len(kept[-1])
+            if spool is not None:
+                spool.write(chunk)
+
+        if full:
+            captured = b''.join(kept)
+        elif digest is not None:
+            captured = BodyDigest(length, digest.hexdigest())
+        else:
+            captured = None
+        if spool is not None:
+            spool.seek(0)
+            body = spool
+        elif streamed and self._capture_all:  # kept whole
+            body = BytesIO(captured)
+        return (request._replace(body=body),
+                request._replace(body=captured))
+
+    def _call_back(self, request, match):
+        if self._instrumented:
+            started = time.perf_counter()
+        status, r_headers, body = match['callback'](request)
+        if self._instrumented:
+            self._observe('callback', request, match,
+                          time.perf_counter() - started)
+        return _make_template(status, r_headers, body, match['content_type'])
+
+    def _record_urlopen(self, api, pool, method, url, body=None,
+                        headers=None, **kwargs):
+        request = self._request_class(method, url, body, headers,
+                                      pool.scheme, pool.host, pool.port)
+        kwargs.update(preload_content=False, decode_content=False)
+        real = self._originals[api.HTTPConnectionPool](
+            pool, method, url, body=body, headers=headers, **kwargs)
+        data = real.read(decode_content=False)
+        real.release_conn()
+        r_headers = [(key, value)
+                     for (key, value) in _header_items(real.headers)
+                     if key.lower() != 'transfer-encoding']
+        self._recorder.add(request, real.status, real.reason, r_headers, data)
+
+        r_headers = tuple(r_headers)
+        response = api.HTTPResponse(
+            status=real.status,
+            reason=real.reason,
+            body=BytesIO(data),
+            headers=r_headers,
+            preload_content=False,
+            original_response=_FakeResponse(r_headers),
+        )
+        self._registry.log.add(request, response)
         return response
 
+    def _timeout(self, api, pool, method, url, body, headers, kwargs,
+                 request, match, error):
+        if self._instrumented:
+            self._observe('error', request, match, error)
+        self._registry.log.add(request, error, match)
+        # Like urllib3, retry or raise MaxRetryError once exhausted
+        retries = kwargs.get('retries')
+        if not isinstance(retries, api.Retry):
+            retries = api.Retry.from_int(
+                retries, redirect=kwargs.get('redirect', True),
+                default=getattr(pool, 'retries', None))
+        kwargs['retries'] = retries.increment(method, url, error=error,
+                                              _pool=pool)
+        return self._handle(api, pool, method, url, body=body,
+                            headers=headers, **kwargs)
+
     def start(self):
-        def _urlopen(pool, method, url, body=None, headers=None, **kwargs):
-            return self._urlopen(pool, method, url, body=body, headers=headers,
-                                 **kwargs)
-        target = self._package + '.connectionpool.HTTPConnectionPool.urlopen'
-        self._patcher = mock.patch(target, _urlopen)
-        self._patcher.start()
+        handle = self._record_urlopen if self._recorder else self._handle
+        apis = self._apis
+        # Nested or concurrent activations share a single patch
+        with self._active_lock:
+            self._active += 1
+            if self._active > 1:
+                return
+            self._originals, self._undo = {}, []
+            if self._channel is not None:
+                self._channel.start()
+                self._undo.append(self._channel.stop)
+            for api in apis:
+                # Every Responses pushes its handler on the interceptor, so
+                # the real urlopen is known whatever the activation order
+                pool_class = api.HTTPConnectionPool
+                handler = functools.partial(handle, api)
+                interceptor = _install(pool_class, handler, self._persistent)
+                self._originals[pool_class] = interceptor.original
+                self._undo.append(
+                    functools.partial(_release, interceptor, handler))
 
     def stop(self):
-        self._patcher.stop()
+        with self._active_lock:
+            if not self._active:
+                return
+            self._active -= 1
+            if self._active:
+                return
+            while self._undo:
+                self._undo.pop()()
+            if self._recorder is not None:
+                self._recorder.close()
+                self._recorder = None
+        if self._hooks['stop']:
+            stats = self.get_stats()
+            for func in self._hooks['stop']:
+                func(stats)